@@ -1,143 +1,745 @@
 # Author: AJ Bresler
 # Copyright (c) 2020, AJ Bresler
 
+import argparse
+import collections
+import concurrent.futures
+import multiprocessing
 import sys
 import os
 import time
 import numpy
+import DemToTopoColorRamp
 import DemToTopoConsts
+import DemToTopoDiscovery
+import DemToTopoGeodesy
+import DemToTopoManifest
+import DemToTopoMosaic
+import DemToTopoOutput
+import DemToTopoPreview
+import DemToTopoProfile
 import DemToTopo_HSV_Merge
+import DemToTopo_LUT_Render
+import DemToTopoRegions
+import DemToTopoTerrain
+import DemToTopoTiles
 import DemToTopoUtills
+import DemToTopoWaterLayer
 
-from pathlib import Path
-from osgeo import gdal, ogr, osr
+from osgeo import gdal, ogr
 from osgeo.gdalconst import *
 
 
 def main():
-    # Get command line arguments.
-    if len(sys.argv) != 4:
-        Usage()
-    if not sys.argv[1] or not sys.argv[2] or not sys.argv[3]:
-        Usage()
-
-    folder = sys.argv[1]
-    color_altitude_file = sys.argv[2]
-    file_extension = sys.argv[3]
-    # Load the data from cvs file
-    dem_file_list = get_dem_file_list(folder, file_extension)
+    args = parse_args()
+    DemToTopoUtills.configure_gdal(args.threads, args.gdal_cache)
+
+    folder = args.folder
+    color_altitude_file = args.color_altitude_file
+    file_extension = args.file_extension
+    options = pipeline_options(args)
+    color_ramp = load_color_ramp(color_altitude_file, args.renderer)
+
+    # The DEM files are found as the batch goes. The neighbours of a tile
+    # are looked up among all the DEM files, so a mosaic lists them first.
+    duplicates = []
+    dem_files = skip_duplicate_names(DemToTopoDiscovery.iter_dem_files(folder, file_extension, args.recursive,
+                                                                       args.archives), duplicates)
+    tile_index = None
+    if args.mosaic:
+        dem_files = list(dem_files)
+        tile_index = DemToTopoMosaic.TileIndex(folder, dem_files)
+
+    clean_up(get_out_folder(folder, options))
+
+    # Skip the files the manifest says are unchanged, and record each file
+    # as soon as it is done.
+    on_result = None
+    is_unchanged = None
+    if args.incremental:
+        manifest = DemToTopoManifest.Manifest(folder)
+        parameters = output_parameters(options)
+        is_unchanged = lambda file_name: manifest.is_unchanged(folder, file_name, color_ramp.content_hash,
+                                                               parameters)
+        on_result = lambda result: record_result(manifest, folder, color_ramp.content_hash, parameters, result)
+
+    # The files are found, filtered and read ahead on a thread while the
+    # batch runs, so I/O overlaps with the processing.
+    # The --report counters are process wide, so without workers they would
+    # count the reads of the prefetch thread in the stage running meanwhile.
+    found_files = []
+    skipped = collections.Counter()
+    prefetch_depth = 0 if args.report and args.workers <= 1 else args.prefetch
+    dem_file_list = DemToTopoDiscovery.prefetch(folder, select_files(folder, dem_files, found_files, skipped,
+                                                                     args.resume, is_unchanged), prefetch_depth)
 
     # Process each file
+    if args.workers > 1:
+        results = process_batch_parallel(folder, dem_file_list, color_altitude_file, options, args.workers,
+                                          color_ramp, on_result, tile_index, args.gdal_cache)
+    else:
+        results = process_batch(folder, dem_file_list, color_altitude_file, options, on_result, tile_index)
+
+    for file_name, first_file_name in duplicates:
+        print('Skipped: ' + file_name + ' has the same name as ' + first_file_name)
+    if skipped['removed']:
+        print('Removed: ' + str(skipped['removed']) + ' intermediate files left by an earlier run')
+    if args.resume:
+        print('Resuming: ' + str(skipped['done']) + ' files already done')
+    if args.incremental:
+        print('Unchanged: ' + str(skipped['unchanged']) + ' files')
+
+    if args.incremental:
+        manifest.save()
+    DemToTopoUtills.remove_folder(get_out_folder(folder, options) + DemToTopoConsts.STAGING_FOLDER)
+    processed = [result[0] for result in results if result[2] is None]
+    if args.mosaic:
+        fn_water, water = DemToTopoMosaic.merge_water(folder, tile_index, args.geodesic)
+        print('Water: ' + str(sum(len(geometries) for geometries in water.values())) + ' polygons in ' + fn_water)
+    if args.water_layer:
+        fn_layer = os.path.join(folder, args.water_layer)
+        if args.mosaic:
+            polygon_count = DemToTopoWaterLayer.write_water_layer(fn_layer, water)
+        else:
+            polygon_count = DemToTopoWaterLayer.update_water_layer(folder, fn_layer, found_files, processed)
+        print('Water layer: ' + str(polygon_count) + ' polygons written to ' + fn_layer)
+    if args.tiles:
+        tile_count = DemToTopoTiles.update_tiles(folder, processed, args.tiles, args.tile_format)
+        print('Tiles: ' + str(tile_count) + ' updated')
+    if args.report:
+        DemToTopoProfile.write_report(args.report, results)
+
+    failed = [result[0] for result in results if result[2] is not None]
+    if failed:
+        print('Failed: ' + str(len(failed)) + ' of ' + str(len(results)) + ' files')
+    print('Completed', end='\n')
+    if failed:
+        sys.exit(1)
+
+
+def skip_duplicate_names(dem_files, duplicates):
+    # The products, staging folder and tile parts of a DEM are named after
+    # its file name, so of the DEMs with the same name in different sub
+    # folders or archives only the first is processed. The others are added
+    # to duplicates as (file name, first file name).
+    first_file_names = {}
+    for file_name in dem_files:
+        dem_name = os.path.splitext(os.path.basename(file_name))[0]
+        if dem_name in first_file_names:
+            duplicates.append((file_name, first_file_names[dem_name]))
+        else:
+            first_file_names[dem_name] = file_name
+            yield file_name
+
+
+def select_files(folder, dem_files, found_files, skipped, resume=False, is_unchanged=None):
+    # Yields the DEM files to process. Every file found goes in found_files
+    # and skipped counts the files skipped and intermediates removed.
+    for file_name in dem_files:
+        found_files.append(file_name)
+        skipped['removed'] += remove_intermediates(folder, file_name)
+        # Products are committed atomically, so a DEM with products is done.
+        if resume and has_products(folder, file_name):
+            skipped['done'] += 1
+        elif is_unchanged is not None and is_unchanged(file_name):
+            skipped['unchanged'] += 1
+        else:
+            yield file_name
+
+
+def process_batch(folder, dem_file_list, color_altitude_file, options, on_result=None, tile_index=None):
+    results = []
     for file_name in dem_file_list:
         print('Processing: ' + file_name, end="")
-        start_time = time.time()
+        result = run_dem_file(folder, file_name, color_altitude_file,
+                              get_file_options(folder, options, tile_index, file_name))
+        print_result(result)
+        if on_result is not None:
+            on_result(result)
+        results.append(result)
+
+    return results
+
+
+def load_color_ramp(color_altitude_file, renderer):
+    # Read the colour file once per batch, and build the tables the renderer
+    # needs before any worker starts. The hsv renderer hands the file to
+    # GDAL as it is; the lut renderer parses and validates it here.
+    try:
+        color_ramp = DemToTopoColorRamp.load_color_ramp(color_altitude_file)
+        if renderer == 'lut':
+            DemToTopo_LUT_Render.get_topo_lut(color_ramp)
+    except (OSError, ValueError) as e:
+        sys.exit('ERROR: ' + str(e))
+
+    return color_ramp
+
+
+def process_batch_parallel(folder, dem_file_list, color_altitude_file, options, workers, color_ramp=None,
+                           on_result=None, tile_index=None, gdal_cache=None):
+    # Each worker processes whole files. Files are submitted as they come,
+    # a few per worker ahead, and results come back in submission order so
+    # the report reads the same as a sequential run.
+    results = []
+    pool = WorkerPool(workers, (color_ramp, options['threads'], gdal_cache))
+    try:
+        for file_name in dem_file_list:
+            pool.submit(file_name, (folder, file_name, color_altitude_file,
+                                    get_file_options(folder, options, tile_index, file_name)))
+            if len(pool.pending) >= workers * DemToTopoConsts.WORKER_QUEUE_FILES:
+                results.append(collect_result(*pool.pop(), on_result))
+        while pool.pending:
+            results.append(collect_result(*pool.pop(), on_result))
+    finally:
+        pool.shutdown()
+
+    return results
+
+
+# =============================================================================
+# WorkerPool
+#
+# The process pool of --workers and the files submitted to it, oldest first.
+# A worker that dies, e.g. on a crash inside GDAL, breaks the whole pool:
+# every file that had not finished fails with BrokenProcessPool, not only the
+# one that crashed, and nothing more can be submitted. The oldest of them is
+# then run again alone in a new pool, so it is reported as failed only when
+# it crashes by itself, and the others are submitted again to the new pool.
+
+class WorkerPool:
+    def __init__(self, workers, initargs):
+        self.workers = workers
+        self.initargs = initargs
+        self.executor = self.create_executor()
+        self.pending = collections.deque()
+
+    def create_executor(self):
+        # The workers are spawned, not forked: the prefetch thread may be
+        # inside GDAL, holding its locks, when a pool is started.
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=init_worker, initargs=self.initargs)
+
+    def submit(self, file_name, args):
+        self.pending.append([file_name, args, self.try_submit(args)])
+
+    def try_submit(self, args):
+        # A broken pool refuses new files, they get a future that failed the
+        # same way and are submitted again once the pool is replaced.
+        try:
+            return self.executor.submit(run_dem_file, *args)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+            return future
+
+    def pop(self):
+        # The oldest file and its finished future.
+        file_name, args, future = self.pending.popleft()
+        concurrent.futures.wait([future])
+        if is_broken(future):
+            self.replace_executor()
+            future = self.try_submit(args)
+            concurrent.futures.wait([future])
+            if is_broken(future):
+                self.replace_executor()
+            self.resubmit()
+        return file_name, future
+
+    def replace_executor(self):
+        # Shutting the broken pool down waits until all its futures failed.
+        self.executor.shutdown()
+        self.executor = self.create_executor()
+
+    def resubmit(self):
+        for entry in self.pending:
+            if is_broken(entry[2]):
+                entry[2] = self.try_submit(entry[1])
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def is_broken(future):
+    return future.done() and isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool)
+
+
+def collect_result(file_name, future, on_result=None):
+    try:
+        result = future.result()
+    except Exception as e:
+        # The worker process itself died running this file, e.g. a crash inside GDAL.
+        result = (file_name, 0.0, repr(e), None, None)
+    print('Processing: ' + file_name, end="")
+    print_result(result)
+    if on_result is not None:
+        on_result(result)
+
+    return result
+
+
+def get_file_options(folder, options, tile_index, file_name):
+    # In a mosaic run each file also gets the neighbouring tiles its halo
+    # is read from.
+    if tile_index is None or not options['halo']:
+        return options
+    return dict(options, neighbours=[DemToTopoDiscovery.get_source_path(folder, neighbour)
+                                     for neighbour in tile_index.get_neighbours(file_name, options['halo'])])
+
+
+def init_worker(color_ramp, threads=1, gdal_cache=None):
+    # The parent's colour ramp, with its tables, is handed over once per worker.
+    DemToTopoUtills.set_progress(False)
+    DemToTopoUtills.configure_gdal(threads, gdal_cache)
+    if color_ramp is not None:
+        DemToTopoColorRamp.add_color_ramp(color_ramp)
+
+
+def run_dem_file(folder, file_name, color_altitude_file, options):
+    # Errors are returned rather than raised so one bad tile doesn't stop the batch.
+    # The products of a file in a sub folder or an archive go in folder.
+    start_time = time.time()
+    DemToTopoProfile.start()
+    try:
+        source_folder, source_name = DemToTopoDiscovery.split_source(folder, file_name)
+        outputs = process_dem_file(source_folder, source_name, color_altitude_file,
+                                   out_folder=get_out_folder(folder, options), **options)
+        error = None
+    except Exception as e:
+        outputs = None
+        error = repr(e)
+
+    return file_name, time.time() - start_time, error, outputs, DemToTopoProfile.finish()
+
+
+def get_out_folder(folder, options):
+    # Previews go in a folder of their own, next to the full resolution products.
+    if options.get('preview_size') or options.get('preview_factor'):
+        return folder + DemToTopoConsts.PREVIEW_FOLDER
+    return folder
+
+
+def record_result(manifest, folder, color_hash, parameters, result):
+    file_name, process_time, error, outputs, stages = result
+    if error is None:
+        manifest.record(folder, file_name, color_hash, parameters, [output for output in outputs if output])
+        manifest.save_if_due()
+
+
+def print_result(result):
+    file_name, process_time, error, outputs, stages = result
+    if error is None:
+        print('Process time: ' + str(process_time))
+    else:
+        print('Failed: ' + error)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('folder', nargs='?')
+    parser.add_argument('color_altitude_file', nargs='?')
+    parser.add_argument('file_extension', nargs='?')
+    parser.add_argument('--in-memory', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--tile-size', type=int)
+    parser.add_argument('--hsv-kernel', choices=DemToTopoConsts.HSV_KERNELS, default='reference')
+    parser.add_argument('--renderer', choices=DemToTopoConsts.RENDERERS, default='hsv')
+    parser.add_argument('--terrain', choices=DemToTopoConsts.TERRAIN_MODES, default='gdal')
+    parser.add_argument('--geodesic', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--report')
+    parser.add_argument('--topo-profile', choices=DemToTopoConsts.TOPO_PROFILES, default='gtiff')
+    parser.add_argument('--tiles', choices=DemToTopoConsts.TILE_SCHEMES)
+    parser.add_argument('--tile-format', choices=DemToTopoConsts.TILE_FORMATS, default='png')
+    parser.add_argument('--tile-zoom', type=zoom_range, default=DemToTopoConsts.TILE_ZOOM)
+    parser.add_argument('--mosaic', action='store_true')
+    parser.add_argument('--halo', type=int, default=DemToTopoConsts.MOSAIC_HALO)
+    parser.add_argument('--water-layer')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--gdal-cache', type=int)
+    parser.add_argument('--recursive', action='store_true')
+    parser.add_argument('--archives', action='store_true')
+    parser.add_argument('--prefetch', type=int, default=DemToTopoConsts.PREFETCH_DEPTH)
+    parser.add_argument('--preview', type=int)
+    parser.add_argument('--preview-factor', type=int)
+
+    args, unknown = parser.parse_known_args(argv)
+    if unknown or not args.folder or not args.color_altitude_file or not args.file_extension or args.halo < 1:
+        Usage()
+    if args.water_layer and (os.path.splitext(args.water_layer)[1].lower() not in
+                             DemToTopoConsts.WATER_LAYER_FORMATS):
+        Usage()
+    if any(value is not None and value < 1 for value in (args.preview, args.preview_factor)):
+        Usage()
+    # A tile of a mosaic depends on its neighbours, which the manifest
+    # doesn't track.
+    if args.mosaic and args.incremental:
+        Usage()
+    # A preview is a quick look, the batch products are left alone.
+    if (args.preview or args.preview_factor) and (args.incremental or args.resume or args.mosaic or args.tiles or
+                                                  args.water_layer):
+        Usage()
 
-        out_cr_name = create_color_relief(folder, file_name, color_altitude_file)
-        out_hill_shade_name = create_hill_shade(folder, file_name)
-        out_slope_name = create_slope(folder, file_name)
-        out_sl_hs_name = create_slope_hill_shade(folder, file_name, out_slope_name, out_hill_shade_name)
-        out_topo_name = DemToTopo_HSV_Merge.hsv_merge(folder, file_name, out_sl_hs_name, out_cr_name)
-        out_slope_water = create_slope_water(folder, file_name, out_slope_name)
-        out_vector_water = create_slope_poly(folder, file_name, out_slope_water)
-        rasterize_water_to_topo(folder, out_topo_name, out_vector_water)
+    return args
+
+
+def zoom_range(value):
+    # 'MIN-MAX' or a single zoom level, as a [min, max] list.
+    try:
+        levels = [int(level) for level in value.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected MIN-MAX zoom levels')
+    if len(levels) == 1:
+        levels *= 2
+    if len(levels) != 2 or not 0 <= levels[0] <= levels[1] <= DemToTopoConsts.TILE_MAX_ZOOM:
+        raise argparse.ArgumentTypeError('expected MIN-MAX zoom levels')
+    return levels
+
+
+def pipeline_options(args):
+    return {'in_memory': args.in_memory,
+            'stream': args.stream,
+            'tile_size': args.tile_size,
+            'hsv_kernel': args.hsv_kernel,
+            'renderer': args.renderer,
+            'terrain': args.terrain,
+            'geodesic': args.geodesic,
+            'topo_profile': args.topo_profile,
+            'tile_zoom': args.tile_zoom if args.tiles else None,
+            'halo': args.halo if args.mosaic else 0,
+            'threads': args.threads,
+            'preview_size': args.preview,
+            'preview_factor': args.preview_factor}
+
+
+def output_parameters(options):
+    # The options that change the products, recorded in the manifest.
+    return {name: options[name] for name in DemToTopoConsts.OUTPUT_OPTIONS}
+
+
+def process_dem_file(folder, file_name, color_altitude_file, in_memory=False, stream=False, tile_size=None,
+                     hsv_kernel='reference', renderer='hsv', terrain='gdal', geodesic=False, out_folder=None,
+                     color_ramp=None, water=True, topo_profile='gtiff', tile_zoom=None, halo=0, neighbours=None,
+                     threads=1, preview_size=None, preview_factor=None):
+    # Everything is written to a staging folder of its own and the products
+    # are moved into the output folder (the DEM folder by default) once
+    # complete, so a crash never leaves a partial _Topo.tif or _SL_poly.shp
+    # behind. In memory mode the intermediate rasters live in /vsimem/
+    # instead of the staging folder. water=False skips the water polygons.
+    # A topo_profile other than gtiff renders the image uncompressed with the
+    # intermediates and writes the product, with overviews, from it.
+    # tile_zoom (min, max) also cuts the image into web map tile parts.
+    # With a halo and neighbouring tiles (a mosaic run) the terrain stages
+    # read the DEM halo pixels larger, from a VRT over the neighbours, so
+    # slope and hill-shade carry on across tile borders. The render and the
+    # water polygons are cropped back to the tile. threads runs the NumPy
+    # stages on that many windows of the tile at a time. preview_size (the
+    # larger side in pixels) or preview_factor runs every stage on a
+    # decimated DEM instead, for a quick look; a preview has no halo.
+    out_folder = out_folder or folder
+    stage_folder = get_stage_folder(out_folder, file_name)
+    DemToTopoUtills.make_folder(stage_folder)
+    work_folder = DemToTopoConsts.VSIMEM_FOLDER if in_memory else stage_folder
+    color_ramp = color_ramp or DemToTopoColorRamp.load_color_ramp(color_altitude_file)
+
+    topo_folder = stage_folder if topo_profile == 'gtiff' else work_folder
+
+    intermediates = []
+    try:
+        scr_dem = folder + file_name
+        window = None
+        if preview_size or preview_factor:
+            with DemToTopoProfile.stage('preview'):
+                scr_dem = DemToTopoPreview.create_preview_vrt(
+                    scr_dem, preview_size, preview_factor,
+                    work_folder + DemToTopoUtills.add_file_name_marker_vrt(file_name, DemToTopoConsts.PREVIEW_EXT))
+            intermediates.append(scr_dem)
+        elif halo and neighbours:
+            with DemToTopoProfile.stage('halo'):
+                scr_dem, window = DemToTopoMosaic.create_halo_vrt(
+                    folder, file_name, neighbours, halo,
+                    work_folder + DemToTopoUtills.add_file_name_marker_vrt(file_name, DemToTopoConsts.HALO_EXT))
+            intermediates.append(scr_dem)
+
+        if terrain == 'fused':
+            with DemToTopoProfile.stage('terrain'):
+                out_sl_hs_name, out_slope_water = DemToTopoTerrain.create_terrain(work_folder, file_name,
+                                                                                  scr_dem, stream,
+                                                                                  tile_size, geodesic, threads)
+        else:
+            with DemToTopoProfile.stage('hill_shade'):
+                out_hill_shade_name = create_hill_shade(folder, file_name, work_folder, scr_dem)
+            intermediates.append(out_hill_shade_name)
+            with DemToTopoProfile.stage('slope'):
+                out_slope_name = create_slope(folder, file_name, work_folder, scr_dem)
+            intermediates.append(out_slope_name)
+            with DemToTopoProfile.stage('slope_hill_shade'):
+                out_sl_hs_name = create_slope_hill_shade(work_folder, file_name, out_slope_name,
+                                                         out_hill_shade_name, stream, tile_size, threads)
+            with DemToTopoProfile.stage('water_mask'):
+                out_slope_water = create_slope_water(work_folder, file_name, out_slope_name, stream, tile_size,
+                                                     threads)
+        intermediates += [out_sl_hs_name, out_slope_water]
+
+        # The water mask is filtered before rendering, the render paints the
+        # water from it and the polygons are made from the same mask. With a
+        # halo the regions on its edge are kept whatever their size, so the
+        # tile's own products are not area filtered at the tile border, only
+        # the merged water layer is.
+        if water:
+            with DemToTopoProfile.stage('sieve'):
+                sieve_slope_water(out_slope_water, geodesic, window is not None)
+
+        if window is not None:
+            out_sl_hs_name = DemToTopoMosaic.crop_to_window(
+                out_sl_hs_name, window,
+                work_folder + DemToTopoUtills.add_file_name_marker_vrt(out_sl_hs_name, DemToTopoConsts.CROP_EXT))
+            out_slope_water = DemToTopoMosaic.crop_to_window(
+                out_slope_water, window,
+                work_folder + DemToTopoUtills.add_file_name_marker_vrt(out_slope_water, DemToTopoConsts.CROP_EXT))
+            intermediates += [out_sl_hs_name, out_slope_water]
+        scr_water = out_slope_water if water else None
+        # The render reads the DEM the texture was made from, without the halo.
+        scr_render_dem = folder + file_name if window is not None else scr_dem
+
+        if renderer == 'lut':
+            with DemToTopoProfile.stage('lut_render'):
+                out_topo_name = DemToTopo_LUT_Render.lut_render(topo_folder, file_name, scr_render_dem,
+                                                                out_sl_hs_name, color_ramp, tile_size, scr_water,
+                                                                threads)
+        else:
+            with DemToTopoProfile.stage('color_relief'):
+                out_cr_name = create_color_relief(folder, file_name, color_ramp.file_name, work_folder,
+                                                  scr_render_dem)
+            intermediates.append(out_cr_name)
+            with DemToTopoProfile.stage('hsv_merge'):
+                out_topo_name = DemToTopo_HSV_Merge.hsv_merge(topo_folder, file_name, out_sl_hs_name,
+                                                              out_cr_name, tile_size, hsv_kernel, scr_water,
+                                                              threads)
+
+        # A render in /vsimem/ is removed by write_topo(), or here on failure.
+        if topo_folder != stage_folder:
+            intermediates.append(out_topo_name)
+
+        if water:
+            with DemToTopoProfile.stage('polygonize'):
+                out_vector_water = create_slope_poly(stage_folder, file_name, out_slope_water)
+
+        if topo_profile != 'gtiff':
+            with DemToTopoProfile.stage('topo_profile'):
+                DemToTopoOutput.write_topo(out_topo_name, stage_folder + os.path.basename(out_topo_name),
+                                           topo_profile)
+
+        if tile_zoom:
+            with DemToTopoProfile.stage('tiles'):
+                DemToTopoTiles.create_tile_parts(stage_folder + os.path.basename(out_topo_name),
+                                                 stage_folder + DemToTopoConsts.TILE_PARTS_FOLDER, tile_zoom)
+
+        with DemToTopoProfile.stage('commit'):
+            out_topo_name, out_vector_water = commit_products(out_folder, file_name, stage_folder)
+        return out_topo_name, out_vector_water if water else None
+    finally:
+        for intermediate in intermediates:
+            remove_vsimem_file(intermediate)
+        DemToTopoUtills.remove_folder(stage_folder)
+
+
+def get_stage_folder(folder, file_name):
+    return folder + DemToTopoConsts.STAGING_FOLDER + os.path.splitext(file_name)[0] + '/'
+
+
+def get_product_names(folder, file_name):
+    # The shapefile components first and the _Topo.tif last, the order they
+    # are committed in.
+    shp_name = DemToTopoUtills.add_file_name_marker_shp(file_name, DemToTopoConsts.SLOPE_POLY_EXT)
+    product_names = [os.path.splitext(shp_name)[0] + extension for extension in DemToTopoConsts.SHAPEFILE_EXTS]
+    product_names.append(DemToTopoUtills.add_file_name_marker_tif(file_name, DemToTopoConsts.TOPO_EXT))
+
+    return [folder + product_name for product_name in product_names]
+
+
+def commit_products(folder, file_name, stage_folder):
+    # Renaming is atomic within a file system, the staging folder is inside
+    # the output folder. The _Topo.tif goes last, so a DEM with a _Topo.tif
+    # has all of its products. Tile parts replace the DEM's earlier parts.
+    stage_parts_folder = stage_folder + DemToTopoConsts.TILE_PARTS_FOLDER
+    if DemToTopoUtills.file_exists(stage_parts_folder):
+        parts_folder = (folder + DemToTopoConsts.TILES_FOLDER + DemToTopoConsts.TILE_PARTS_FOLDER +
+                        os.path.splitext(file_name)[0])
+        DemToTopoUtills.remove_folder(parts_folder)
+        DemToTopoUtills.make_folder(os.path.dirname(parts_folder))
+        DemToTopoUtills.rename_file(stage_parts_folder.rstrip('/'), parts_folder)
+
+    for staged_name, product_name in zip(get_product_names(stage_folder, file_name),
+                                         get_product_names(folder, file_name)):
+        if DemToTopoUtills.file_exists(staged_name):
+            DemToTopoUtills.rename_file(staged_name, product_name)
+
+    return get_output_names(folder, file_name)
+
+
+def get_output_names(folder, file_name):
+    out_topo_name = folder + DemToTopoUtills.add_file_name_marker_tif(file_name, DemToTopoConsts.TOPO_EXT)
+    out_vector_water = folder + DemToTopoUtills.add_file_name_marker_shp(file_name, DemToTopoConsts.SLOPE_POLY_EXT)
+    return out_topo_name, out_vector_water
+
+
+def remove_vsimem_file(file_name):
+    # Files in the staging folder go with the folder.
+    if file_name.startswith(DemToTopoConsts.VSIMEM_FOLDER) and DemToTopoUtills.file_exists(file_name):
+        DemToTopoUtills.remove_file(file_name)
+
+
+def has_products(folder, file_name):
+    return all(os.path.exists(output_name) for output_name in get_output_names(folder, file_name))
+
+
+def clean_up(folder):
+    # Remove the staging folder an interrupted run left behind.
+    DemToTopoUtills.remove_folder(folder + DemToTopoConsts.STAGING_FOLDER)
 
-        os.remove(out_cr_name)
-        os.remove(out_hill_shade_name)
-        os.remove(out_slope_name)
-        os.remove(out_sl_hs_name)
-        os.remove(out_slope_water)
 
-        print('Process time: ' + str(time.time() - start_time))
+def remove_intermediates(folder, file_name):
+    # Remove the intermediate rasters older versions wrote next to the DEM.
+    source_folder, source_name = DemToTopoDiscovery.split_source(folder, file_name)
+    removed = 0
+    for marker in DemToTopoConsts.INTERMEDIATE_EXTS:
+        intermediate = source_folder + DemToTopoUtills.add_file_name_marker_tif(source_name, marker)
+        if os.path.exists(intermediate):
+            os.remove(intermediate)
+            removed += 1
 
-    print('Completed', end='\n')
+    return removed
 
 
 def get_dem_file_list(folder, file_extension):
-    dem_file_list = []
-    with os.scandir(folder) as entries:
-        for entry in entries:
-            if entry.is_file():
-                if Path(entry.name).suffix == '.' + file_extension:
-                    dem_file_list.append(entry.name)
-
-    return dem_file_list
+    return list(DemToTopoDiscovery.iter_dem_files(folder, file_extension))
 
 
-def create_color_relief(folder, scr_filename, color_altitude_file):
-    out_filename = folder + DemToTopoUtills.add_file_name_marker_tif(scr_filename, DemToTopoConsts.COLOR_RELIEF_EXT)
-    gdal.DEMProcessing(out_filename, folder + scr_filename, 'color-relief', format='GTiff',
+def create_color_relief(folder, scr_filename, color_altitude_file, out_folder=None, scr_dem=None):
+    out_filename = (out_folder or folder) + DemToTopoUtills.add_file_name_marker_tif(scr_filename,
+                                                                                   DemToTopoConsts.COLOR_RELIEF_EXT)
+    gdal.DEMProcessing(out_filename, scr_dem or folder + scr_filename, 'color-relief', format='GTiff',
                        colorFilename=color_altitude_file)
 
     DemToTopoUtills.print_dot()
     return out_filename
 
 
-def create_hill_shade(folder, scr_filename):
-    out_filename = folder + DemToTopoUtills.add_file_name_marker_tif(scr_filename, DemToTopoConsts.HILL_SHADE_EXT)
-    gdal.DEMProcessing(out_filename, folder + scr_filename, 'hillshade', format='GTiff',
-                       zFactor=5, scale=111120, azimuth=90, computeEdges=True)
+def create_hill_shade(folder, scr_filename, out_folder=None, scr_dem=None):
+    out_filename = (out_folder or folder) + DemToTopoUtills.add_file_name_marker_tif(scr_filename,
+                                                                                   DemToTopoConsts.HILL_SHADE_EXT)
+    gdal.DEMProcessing(out_filename, scr_dem or folder + scr_filename, 'hillshade', format='GTiff',
+                       zFactor=DemToTopoConsts.HILL_SHADE_Z_FACTOR, scale=DemToTopoConsts.TERRAIN_SCALE,
+                       azimuth=DemToTopoConsts.HILL_SHADE_AZIMUTH, computeEdges=True)
 
     DemToTopoUtills.print_dot()
     return out_filename
 
 
-def create_slope(folder, scr_filename):
-    out_filename = folder + DemToTopoUtills.add_file_name_marker_tif(scr_filename, DemToTopoConsts.SLOPE_EXT)
-    gdal.DEMProcessing(out_filename, folder + scr_filename, 'slope', format='GTiff',
-                       scale=111120, azimuth=90, computeEdges=True)
+def create_slope(folder, scr_filename, out_folder=None, scr_dem=None):
+    out_filename = (out_folder or folder) + DemToTopoUtills.add_file_name_marker_tif(scr_filename,
+                                                                                   DemToTopoConsts.SLOPE_EXT)
+    gdal.DEMProcessing(out_filename, scr_dem or folder + scr_filename, 'slope', format='GTiff',
+                       scale=DemToTopoConsts.TERRAIN_SCALE, azimuth=DemToTopoConsts.HILL_SHADE_AZIMUTH,
+                       computeEdges=True)
 
     DemToTopoUtills.print_dot()
     return out_filename
 
 
-def create_slope_hill_shade(folder, fn_dem, fn_sl, fn_hs):
+def create_slope_hill_shade(folder, fn_dem, fn_sl, fn_hs, stream=False, tile_size=None, threads=1):
     fn_sl_hs = folder + DemToTopoUtills.add_file_name_marker_tif(fn_dem, DemToTopoConsts.SLOPE_HILL_SHADE_EXT)
 
     ds_sl = gdal.Open(fn_sl)
     ds_hs = gdal.Open(fn_hs)
 
-    driver_tiff = gdal.GetDriverByName('GTiff')
+    driver_tiff = DemToTopoUtills.get_driver('GTiff')
     ds_sl_hs = driver_tiff.CreateCopy(fn_sl_hs, ds_sl, strict=0)
 
-    band_sl = ds_sl.GetRasterBand(1).ReadAsArray()
-    band_hs = ds_hs.GetRasterBand(1).ReadAsArray()
+    sl_band = ds_sl.GetRasterBand(1)
+    hs_band = ds_hs.GetRasterBand(1)
+    sl_hs_band = ds_sl_hs.GetRasterBand(1)
 
-    band_sl_hs = ((((band_sl / 90) * 255) * 0.7) + (band_hs * 0.3)) + 70
-
-    ds_sl_hs.GetRasterBand(1).WriteArray(band_sl_hs)
+    # Per pixel stage, no halo needed. Threads work on stripes.
+    window_x_size, window_y_size = DemToTopoUtills.get_window_size(sl_band, stream or threads > 1, tile_size)
+    DemToTopoUtills.process_windows(
+        DemToTopoUtills.get_windows(sl_band.XSize, sl_band.YSize, window_x_size, window_y_size),
+        lambda windows: (sl_band.ReadAsArray(*windows[0]), hs_band.ReadAsArray(*windows[0])),
+        lambda blocks: slope_hill_shade(*blocks),
+        lambda windows, band_sl_hs: sl_hs_band.WriteArray(band_sl_hs, windows[0][0], windows[0][1]),
+        threads)
 
     ds_sl = None
     ds_hs = None
     ds_sl_hs = None
-    band_sl = None
-    band_hs = None
-    band_sl_hs = None
+    sl_band = None
+    hs_band = None
+    sl_hs_band = None
 
     DemToTopoUtills.print_dot()
     return fn_sl_hs
 
 
-def create_slope_water(folder, fn_dem, fn_sl):
+def slope_hill_shade(band_sl, band_hs):
+    return ((((band_sl / 90) * 255) * 0.7) + (band_hs * 0.3)) + 70
+
+
+def create_slope_water(folder, fn_dem, fn_sl, stream=False, tile_size=None, threads=1):
     fn_sl_water = folder + DemToTopoUtills.add_file_name_marker_tif(fn_dem, DemToTopoConsts.SLOPE_WATER_EXT)
 
     ds_sl = gdal.Open(fn_sl)
 
-    driver_tiff = gdal.GetDriverByName('GTiff')
-    ds_sl_water = driver_tiff.CreateCopy(fn_sl_water, ds_sl, strict=0)
-    ds_sl_water.GetRasterBand(1).SetNoDataValue(0)
-
-    band_sl = ds_sl.GetRasterBand(1).ReadAsArray()
+    # 1 bit 0/1 mask, flat (zero slope) pixels are water.
+    ds_sl_water = DemToTopoUtills.create_mask_raster(fn_sl_water, ds_sl)
 
-    band_sl_water = numpy.where(band_sl != 0, 2, band_sl)
-    band_sl_water = numpy.where(band_sl_water == 0, 1, band_sl_water)
-    band_sl_water = numpy.where(band_sl_water == 2, 0, band_sl_water)
+    sl_band = ds_sl.GetRasterBand(1)
+    sl_water_band = ds_sl_water.GetRasterBand(1)
 
-    ds_sl_water.GetRasterBand(1).WriteArray(band_sl_water)
+    # Per pixel stage, no halo needed. Threads work on stripes.
+    window_x_size, window_y_size = DemToTopoUtills.get_window_size(sl_band, stream or threads > 1, tile_size)
+    DemToTopoUtills.process_windows(
+        DemToTopoUtills.get_windows(sl_band.XSize, sl_band.YSize, window_x_size, window_y_size),
+        lambda windows: sl_band.ReadAsArray(*windows[0]),
+        water_mask,
+        lambda windows, band_sl_water: sl_water_band.WriteArray(band_sl_water, windows[0][0], windows[0][1]),
+        threads)
 
+    sl_band = None
+    sl_water_band = None
     ds_sl = None
     ds_sl_water = None
-    band_sl = None
-    band_sl_water = None
+
+    DemToTopoUtills.print_dot()
+    return fn_sl_water
+
+
+def water_mask(band_sl):
+    return numpy.equal(band_sl, 0).view(numpy.uint8)
+
+
+def sieve_slope_water(fn_sl_water, geodesic=False, keep_edges=False):
+    # Clear the water regions that are too small, in place, so only the water
+    # that is kept gets rendered and polygonized. geodesic measures the
+    # regions in square metres using the ground area of the pixels of each
+    # row. keep_edges keeps the regions on the edge of a mask with a halo,
+    # merge_water() measures them with the rest of the lake.
+    dn_sl = gdal.Open(fn_sl_water, GA_Update)
+    band_input = dn_sl.GetRasterBand(1)
+
+    geo_transform = dn_sl.GetGeoTransform()
+    if geodesic:
+        row_areas = DemToTopoGeodesy.row_pixel_areas(geo_transform, band_input.YSize,
+                                                     DemToTopoGeodesy.is_geographic(dn_sl))
+        DemToTopoRegions.sieve_mask(band_input, DemToTopoConsts.WATER_MIN_AREA_M2, row_areas, keep_edges)
+    else:
+        row_areas = numpy.full(band_input.YSize, abs(geo_transform[1] * geo_transform[5]))
+        DemToTopoRegions.sieve_mask(band_input, DemToTopoConsts.WATER_MIN_AREA, row_areas, keep_edges)
+
+    band_input = None
+    dn_sl = None
 
     DemToTopoUtills.print_dot()
     return fn_sl_water
@@ -146,74 +748,103 @@ def create_slope_water(folder, fn_dem, fn_sl):
 def create_slope_poly(folder, fn_dem, fn_sl_water):
     fn_sl_poly = folder + DemToTopoUtills.add_file_name_marker_shp(fn_dem, DemToTopoConsts.SLOPE_POLY_EXT)
     # print(fn_sl_poly)
-    dn_sl = gdal.Open(fn_sl_water)
+    dn_sl = gdal.Open(fn_sl_water, GA_ReadOnly)
     band_input = dn_sl.GetRasterBand(1)
 
-    # create the spatial reference, WGS84
-    source_srs = osr.SpatialReference()
-    source_srs.ImportFromEPSG(4326)
+    # the spatial reference, WGS84
+    source_srs = DemToTopoUtills.get_wgs84()
 
-    driver_file = ogr.GetDriverByName("ESRI Shapefile")
-    driver_mem = ogr.GetDriverByName('Memory')
+    driver_file = DemToTopoUtills.get_vector_driver("ESRI Shapefile")
 
-    if os.path.exists(fn_sl_poly):
+    if DemToTopoUtills.file_exists(fn_sl_poly):
         driver_file.DeleteDataSource(fn_sl_poly)
 
     out_datasource_file = driver_file.CreateDataSource(fn_sl_poly)
     out_layer_file = out_datasource_file.CreateLayer("polygonized", source_srs, geom_type=ogr.wkbPolygon)
 
-    out_datasource_mem = driver_mem.CreateDataSource('out')
-    out_layer_mem = out_datasource_mem.CreateLayer("polygonized1", source_srs)
-
-    gdal.Polygonize(band_input, band_input, out_layer_mem, -1, [], callback=None)
-
-    for feat in out_layer_mem:
-        # For each feature, get the geometry
-        geom = feat.GetGeometryRef()
-        area = geom.GetArea()
-        if area > 0.0000009:
-            out_layer_file.CreateFeature(feat)
+    # Write the features in one transaction where the driver supports them.
+    use_transaction = out_layer_file.TestCapability(ogr.OLCTransactions)
+    if use_transaction:
+        out_layer_file.StartTransaction()
+    gdal.Polygonize(band_input, band_input, out_layer_file, -1, [], callback=None)
+    if use_transaction:
+        out_layer_file.CommitTransaction()
 
+    out_layer_file = None
     out_datasource_file = None
-    out_datasource_mem = None
+    band_input = None
     dn_sl = None
 
     fn_sl_poly_prj = folder + DemToTopoUtills.add_file_name_marker_prj(fn_dem, DemToTopoConsts.SLOPE_POLY_EXT)
-    spatial_ref = osr.SpatialReference()
-    spatial_ref.ImportFromEPSG(4326)
-
-    spatial_ref.MorphToESRI()
-    file = open(fn_sl_poly_prj, 'w')
-    file.write(spatial_ref.ExportToWkt())
-    file.close()
-    file = None
+    DemToTopoUtills.write_text(fn_sl_poly_prj, DemToTopoUtills.get_wgs84_esri_wkt())
 
     DemToTopoUtills.print_dot()
     return fn_sl_poly
 
 
-def rasterize_water_to_topo(folder, out_topo_name, out_vector_water):
-    ds_topo = gdal.Open(out_topo_name, GF_Write)
-    ds_vector_water = ogr.Open(out_vector_water)
-    layer_vector_water = ds_vector_water.GetLayer()
-
-    gdal.RasterizeLayer(ds_topo, [1, 2, 3], layer_vector_water, burn_values=[DemToTopoConsts.RED_VAL,
-                                                                             DemToTopoConsts.GREEN_VAL,
-                                                                             DemToTopoConsts.BLUE_VAL])
-    DemToTopoUtills.print_dot()
-
-
 def Usage():
-    print("""Usage: DemToTopo.py {DEM data folder} {Color Altitude File} {DEM file extension}
+    print("""Usage: DemToTopo.py {DEM data folder} {Color Altitude File} {DEM file extension or pattern}
+                   [--in-memory] [--workers N] [--stream] [--tile-size N] [--hsv-kernel reference|float32|fused]
+                   [--renderer hsv|lut] [--terrain gdal|fused] [--geodesic]
+                   [--incremental] [--resume] [--report FILE]
+                   [--topo-profile gtiff|deflate|zstd|jpeg|cog]
+                   [--tiles xyz|tms|mbtiles] [--tile-format png|webp] [--tile-zoom MIN-MAX]
+                   [--mosaic] [--halo N] [--water-layer FILE.gpkg|FILE.fgb]
+                   [--threads N] [--gdal-cache MB] [--recursive] [--archives] [--prefetch N]
+                   [--preview N] [--preview-factor N]
 
     where DEM data folder is the dataset path,
           Color Altitude Value Map File is the file path of the file
-          DEM file extension (e.g. bil)
+          DEM file extension (e.g. bil) or a file name pattern (e.g. "s0*_e03*.bil" or "*.vrt")
           intensity for the color dataset.
+          --in-memory keeps the intermediate rasters in /vsimem/ instead of the DEM data folder.
+          --workers N processes N DEM files at a time in separate processes.
+          --stream processes the slope stages window by window using the GTiff block size.
+          --tile-size N streams in N x N pixel windows.
+          --hsv-kernel selects the HSV merge kernels: the float64 reference, allocation free float32
+                       kernels, or the fused float32 rgb to rgb value replacement.
+          --renderer lut renders the topographic image from a precomputed (altitude x intensity) colour
+                     table instead of a GDAL colour relief and HSV merge.
+          --terrain fused computes slope, hill-shade, texture and water mask from one read of the DEM
+                    instead of separate gdaldem slope and hillshade passes.
+          --geodesic applies the minimum water area in square metres using the ground area of each row of
+                     pixels, and with --terrain fused scales slope and hill-shade per row by latitude.
+          --incremental only processes the DEM files that are new or changed since the last run, as recorded
+                        in the DemToTopo_manifest.json file in the DEM data folder.
+          --resume skips the DEM files that already have their _Topo.tif and _SL_poly.shp, to carry on an
+                   interrupted batch.
+          --report FILE writes the wall time, CPU time, peak memory and bytes read and written of every
+                        stage of every file, and a summary per stage for the batch, as JSON, or CSV when
+                        FILE ends with .csv.
+          --topo-profile writes the _Topo.tif as the original uncompressed stripped GTiff (gtiff), as a tiled
+                         GTiff with internal overviews compressed with DEFLATE, ZSTD or JPEG (YCbCr), or as a
+                         Cloud Optimized GeoTIFF (cog).
+          --tiles writes web map tiles of the batch to DemToTopo_tiles in the DEM data folder, as xyz or tms
+                  folders or an MBTiles file, in --tile-format png (default) or webp, for the --tile-zoom
+                  levels (default 8-12). Only the tiles of the DEM files processed are updated.
+          --mosaic processes the DEM files as one seamless mosaic: each tile borrows --halo N (default 1)
+                   pixels from its neighbouring tiles for slope and hill-shade, and the water polygons of
+                   all tiles are merged, with the lakes across tile borders joined, into DemToTopo_water.shp.
+                   Not with --incremental.
+          --water-layer FILE also writes the water polygons of all the DEM files into one GeoPackage (.gpkg) or
+                        FlatGeobuf (.fgb) layer with a spatial index, with the source DEM file, area in
+                        hectares and centroid of each polygon. FILE is relative to the DEM data folder.
+          --threads N runs the NumPy stages of one DEM file on N threads, stripe by stripe, and lets GDAL
+                      encode compressed output on N threads (GDAL_NUM_THREADS).
+          --gdal-cache MB sets the size of the GDAL raster block cache.
+          --recursive also processes the DEM files in the sub folders of the DEM data folder.
+          --archives also processes the DEM files inside .zip files, read in place.
+          --prefetch N reads N DEM files ahead of the one being processed (default 1, 0 reads none ahead).
+                       Off with --report without --workers.
+          --preview N renders a quick preview of each DEM file at most N pixels on its larger side, and
+                      --preview-factor N one decimated N times, into DemToTopo_preview in the DEM data folder.
+                      Not with --incremental, --resume, --mosaic, --tiles or --water-layer.
     """)
     sys.exit(1)
 
-main()
+
+if __name__ == '__main__':
+    main()
 # Press the green button in the gutter to run the script.
 # if __name__ == '__main__':
 #     print_hi('PyCharm')
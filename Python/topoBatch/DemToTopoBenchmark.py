@@ -0,0 +1,381 @@
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy
+import DemToTopo
+import DemToTopoColorRamp
+import DemToTopoConsts
+import DemToTopoOutput
+import DemToTopoSynthetic
+import DemToTopo_HSV_Merge
+import DemToTopo_LUT_Render
+import DemToTopoUtills
+
+from osgeo import gdal
+
+BENCHMARKS = ['pipeline', 'merge', 'kernels', 'profiles', 'synthetic']
+DEFAULT_BENCHMARKS = ['pipeline', 'merge', 'kernels', 'profiles']
+DEM_BENCHMARKS = ['pipeline', 'merge', 'profiles']
+DEFAULT_COLOR_ALTITUDE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Data',
+                                           'ColorRelief02.txt')
+
+
+def main():
+    args = parse_args()
+
+    if 'kernels' in args.benchmark:
+        benchmark_hsv_kernels(args.repeat)
+    if 'synthetic' in args.benchmark:
+        cases = benchmark_synthetic(args.terrain, args.size, args.seed, args.repeat,
+                                    args.color_altitude_file or DEFAULT_COLOR_ALTITUDE_FILE, args.work_folder)
+        if args.save:
+            save_results(args.save, cases, args.seed)
+    if not set(DEM_BENCHMARKS) & set(args.benchmark):
+        return
+
+    if not args.folder or not args.color_altitude_file or not args.file_extension:
+        Usage()
+    dem_file_list = DemToTopo.get_dem_file_list(args.folder, args.file_extension)
+    if not dem_file_list:
+        print('No DEM files found in ' + args.folder)
+        sys.exit(1)
+
+    if 'pipeline' in args.benchmark:
+        benchmark_in_memory(args.folder, dem_file_list, args.color_altitude_file, args.repeat)
+    if 'merge' in args.benchmark:
+        benchmark_hsv_merge(args.folder, dem_file_list, args.color_altitude_file, args.repeat)
+    if 'profiles' in args.benchmark:
+        benchmark_topo_profiles(args.folder, dem_file_list, args.color_altitude_file, args.repeat)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('folder', nargs='?')
+    parser.add_argument('color_altitude_file', nargs='?')
+    parser.add_argument('file_extension', nargs='?')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--benchmark', action='append', choices=BENCHMARKS)
+    parser.add_argument('--terrain', action='append', choices=DemToTopoSynthetic.TERRAINS)
+    parser.add_argument('--size', action='append', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-folder')
+    parser.add_argument('--save')
+
+    args, unknown = parser.parse_known_args(argv)
+    if unknown:
+        Usage()
+    if not args.benchmark:
+        args.benchmark = DEFAULT_BENCHMARKS
+    if not args.terrain:
+        args.terrain = DemToTopoSynthetic.TERRAINS
+    if not args.size:
+        args.size = DemToTopoConsts.SYNTHETIC_SIZES
+    if args.work_folder and not args.work_folder.endswith(('/', os.sep)):
+        args.work_folder += '/'
+
+    return args
+
+
+def benchmark_in_memory(folder, dem_file_list, color_altitude_file, repeat):
+    print('Disk vs in memory pipeline, best of ' + str(repeat))
+    total_disk = 0.0
+    total_memory = 0.0
+    for file_name in dem_file_list:
+        disk_time = best_time(repeat, DemToTopo.process_dem_file, folder, file_name, color_altitude_file, False)
+        memory_time = best_time(repeat, DemToTopo.process_dem_file, folder, file_name, color_altitude_file, True)
+        total_disk += disk_time
+        total_memory += memory_time
+        print_result(file_name, disk_time, memory_time)
+
+    print_result('Total', total_disk, total_memory)
+
+
+def benchmark_hsv_merge(folder, dem_file_list, color_altitude_file, repeat):
+    print('Scanline vs block hsv_merge, best of ' + str(repeat))
+    work_folder = DemToTopoConsts.VSIMEM_FOLDER
+    for file_name in dem_file_list:
+        cr_name, sl_hs_name, intermediates = create_merge_inputs(folder, file_name, color_altitude_file)
+
+        scanline_time = best_time(repeat, DemToTopo_HSV_Merge.hsv_merge_scanline, work_folder, file_name,
+                                  sl_hs_name, cr_name)
+        scanline_bytes = read_raster_bytes(DemToTopo_HSV_Merge.hsv_merge_scanline(work_folder, file_name,
+                                                                                   sl_hs_name, cr_name))
+        block_time = best_time(repeat, DemToTopo_HSV_Merge.hsv_merge, work_folder, file_name, sl_hs_name, cr_name)
+        topo_name = DemToTopo_HSV_Merge.hsv_merge(work_folder, file_name, sl_hs_name, cr_name)
+        block_bytes = read_raster_bytes(topo_name)
+
+        print_result(file_name, scanline_time, block_time)
+        print('Byte identical: ' + str(scanline_bytes == block_bytes))
+
+        # The LUT renderer rounds the intensity down to a byte, so it is
+        # within one of the reference in every channel.
+        block_array = read_raster_array(topo_name)
+        lut_array = read_raster_array(DemToTopo_LUT_Render.lut_render(
+            work_folder, file_name, folder + file_name, sl_hs_name,
+            DemToTopoColorRamp.load_color_ramp(color_altitude_file)))
+        lut_difference = int(numpy.abs(lut_array.astype(numpy.int16) - block_array).max())
+        print('LUT max difference: ' + str(lut_difference) + (' (within one)' if lut_difference <= 1 else ''))
+
+        for intermediate in intermediates + [topo_name]:
+            DemToTopoUtills.remove_file(intermediate)
+
+
+def benchmark_topo_profiles(folder, dem_file_list, color_altitude_file, repeat):
+    # Write time and size of each _Topo.tif output profile against the
+    # uncompressed gtiff output. The render is in /vsimem/, the products are
+    # written to a temporary folder on disk.
+    print('_Topo.tif output profiles, best of ' + str(repeat))
+    work_folder = DemToTopoConsts.VSIMEM_FOLDER
+    out_folder = tempfile.mkdtemp() + '/'
+    try:
+        for file_name in dem_file_list:
+            cr_name, sl_hs_name, intermediates = create_merge_inputs(folder, file_name, color_altitude_file)
+            render_name = DemToTopo_HSV_Merge.hsv_merge(work_folder, file_name, sl_hs_name, cr_name)
+            topo_name = out_folder + os.path.basename(render_name)
+
+            results = {}
+            for profile in DemToTopoConsts.TOPO_PROFILES:
+                write_time = time_topo_profile(repeat, render_name, topo_name, profile)
+                results[profile] = (write_time, os.path.getsize(topo_name))
+                os.remove(topo_name)
+
+            base_time, base_size = results['gtiff']
+            print('\n' + file_name)
+            for profile, (write_time, size) in results.items():
+                print('{0}: write {1:.3f}s ({2:.2f}x gtiff), {3:.1f} MB ({4:.0%} of gtiff)'.format(
+                    profile, write_time, write_time / base_time, size / 2 ** 20, size / base_size))
+
+            for intermediate in intermediates + [render_name]:
+                DemToTopoUtills.remove_file(intermediate)
+    finally:
+        shutil.rmtree(out_folder, ignore_errors=True)
+
+
+def time_topo_profile(repeat, render_name, topo_name, profile):
+    # gtiff is a plain copy of the render, the way hsv_merge writes it. The
+    # other profiles consume their input, so each run gets a fresh copy of
+    # the render in /vsimem/, made outside the timing.
+    best = None
+    copy_name = render_name.replace('.tif', DemToTopoConsts.TOPO_PROFILE_EXT + '.tif')
+    for i in range(repeat):
+        if profile != 'gtiff':
+            DemToTopoUtills.get_driver('GTiff').CreateCopy(copy_name, gdal.Open(render_name))
+        start_time = time.perf_counter()
+        if profile == 'gtiff':
+            DemToTopoUtills.get_driver('GTiff').CreateCopy(topo_name, gdal.Open(render_name))
+        else:
+            DemToTopoOutput.write_topo(copy_name, topo_name, profile)
+        elapsed = time.perf_counter() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def benchmark_hsv_kernels(repeat, shape=(512, 3601)):
+    # Synthetic colour and hillshade blocks the size of a hsv_merge stripe of an SRTM tile.
+    print('HSV merge kernels on a ' + str(shape[0]) + 'x' + str(shape[1]) + ' block, best of ' + str(repeat))
+    rng = numpy.random.default_rng(0)
+    color_block = rng.integers(0, 256, (3,) + shape).astype(numpy.uint8)
+    hill_block = rng.uniform(70, 325, shape).astype(numpy.float32)
+    hill_block[:, :16] = -9999
+    workspace = DemToTopo_HSV_Merge.HsvWorkspace(shape)
+    out = numpy.empty((3,) + shape, numpy.uint8)
+
+    reference = DemToTopo_HSV_Merge.merge_block(color_block, hill_block, -9999)
+    reference_time = best_time(repeat, DemToTopo_HSV_Merge.merge_block, color_block, hill_block, -9999)
+    for fused in (False, True):
+        kernel_time = best_time(repeat, DemToTopo_HSV_Merge.merge_block_f32, color_block, hill_block, -9999,
+                                workspace, out, fused)
+        print_result('fused' if fused else 'float32', reference_time, kernel_time)
+        print('Max channel difference: ' + str(numpy.abs(out.astype(int) - reference).max()))
+
+
+def benchmark_synthetic(terrains, sizes, seed, repeat, color_altitude_file, work_folder=None):
+    # The full pipeline on generated DEMs, best of repeat runs. Every run is in
+    # a fresh process so the peak memory is that of one file. The DEMs are
+    # kept in work_folder when given, otherwise generated in a temporary
+    # folder that is removed afterwards.
+    print('Synthetic DEMs, seed ' + str(seed) + ', best of ' + str(repeat))
+    folder = work_folder or tempfile.mkdtemp() + '/'
+    os.makedirs(folder, exist_ok=True)
+    options = DemToTopo.pipeline_options(DemToTopo.parse_args([folder, color_altitude_file, 'bil']))
+
+    cases = []
+    try:
+        for terrain in terrains:
+            for size in sizes:
+                file_name = terrain + '_' + str(size) + '_' + str(seed) + '.bil'
+                if not os.path.exists(folder + file_name):
+                    DemToTopoSynthetic.create_synthetic_dem(folder + file_name, terrain, size, seed)
+
+                best = None
+                for i in range(repeat):
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                                initializer=DemToTopoUtills.set_progress,
+                                                                initargs=(False,)) as executor:
+                        result = executor.submit(DemToTopo.run_dem_file, folder, file_name, color_altitude_file,
+                                                 options).result()
+                    if best is None or result[1] < best[1]:
+                        best = result
+                    for product_name in DemToTopo.get_product_names(folder, file_name):
+                        if os.path.exists(product_name):
+                            os.remove(product_name)
+
+                case = synthetic_case(terrain, size, best)
+                print_case(case)
+                cases.append(case)
+    finally:
+        if work_folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return cases
+
+
+def synthetic_case(terrain, size, result):
+    file_name, process_time, error, outputs, stages = result
+    megapixels = size * size / 1e6
+    case = {'terrain': terrain, 'size': size, 'error': error, 'time': process_time,
+            'megapixels_per_second': megapixels / process_time if process_time else None,
+            'peak_rss': max([stage['peak_rss'] or 0 for stage in stages or []], default=None),
+            'stages': {}}
+    for stage in stages or []:
+        case['stages'][stage['stage']] = {'time': stage['wall_time'],
+                                          'megapixels_per_second': (megapixels / stage['wall_time']
+                                                                    if stage['wall_time'] else None)}
+
+    return case
+
+
+def print_case(case):
+    name = case['terrain'] + ' ' + str(case['size']) + 'x' + str(case['size'])
+    if case['error'] is not None:
+        print(name + ': failed ' + case['error'])
+        return
+    print('{0}: {1:.3f}s, {2:.2f} Mpx/s, peak {3:.0f} MB'.format(name, case['time'],
+                                                                  case['megapixels_per_second'],
+                                                                  (case['peak_rss'] or 0) / 2 ** 20))
+    for stage_name, stage in case['stages'].items():
+        print('    {0}: {1:.3f}s, {2:.2f} Mpx/s'.format(stage_name, stage['time'], stage['megapixels_per_second']))
+
+
+def save_results(results_file, cases, seed):
+    # One JSON line per run, compared with the previous run in the file so a
+    # regression shows up between commits.
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as file:
+            lines = file.read().splitlines()
+        if lines:
+            previous = json.loads(lines[-1])
+
+    run = {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+           'platform': platform.platform(), 'python': platform.python_version(), 'gdal': gdal.__version__,
+           'numpy': numpy.__version__, 'seed': seed, 'cases': cases}
+    with open(results_file, 'a') as file:
+        file.write(json.dumps(run) + '\n')
+
+    if previous is not None:
+        compare_results(previous, run)
+
+
+def compare_results(previous, run):
+    print('Against ' + str(previous['commit']) + ' of ' + previous['date'])
+    previous_cases = {(case['terrain'], case['size']): case for case in previous['cases']}
+    for case in run['cases']:
+        previous_case = previous_cases.get((case['terrain'], case['size']))
+        if previous_case is None or not previous_case['megapixels_per_second'] or \
+                not case['megapixels_per_second']:
+            continue
+        change = case['megapixels_per_second'] / previous_case['megapixels_per_second'] - 1
+        print('{0} {1}: {2:.2f} Mpx/s, was {3:.2f} ({4:+.1%})'.format(case['terrain'], case['size'],
+                                                                     case['megapixels_per_second'],
+                                                                     previous_case['megapixels_per_second'],
+                                                                     change))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_merge_inputs(folder, file_name, color_altitude_file):
+    work_folder = DemToTopoConsts.VSIMEM_FOLDER
+    cr_name = DemToTopo.create_color_relief(folder, file_name, color_altitude_file, work_folder)
+    hill_shade_name = DemToTopo.create_hill_shade(folder, file_name, work_folder)
+    slope_name = DemToTopo.create_slope(folder, file_name, work_folder)
+    sl_hs_name = DemToTopo.create_slope_hill_shade(work_folder, file_name, slope_name, hill_shade_name)
+
+    return cr_name, sl_hs_name, [cr_name, hill_shade_name, slope_name, sl_hs_name]
+
+
+def read_raster_bytes(file_name):
+    dataset = gdal.Open(file_name)
+    raster_bytes = dataset.ReadRaster()
+    dataset = None
+    return raster_bytes
+
+
+def read_raster_array(file_name):
+    dataset = gdal.Open(file_name)
+    raster_array = dataset.ReadAsArray()
+    dataset = None
+    return raster_array
+
+
+def best_time(repeat, function, *args):
+    best = None
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def print_result(name, base_time, new_time):
+    print('\n{0}: base {1:.3f}s, new {2:.3f}s, speedup {3:.2f}x'.format(name, base_time, new_time,
+                                                                          base_time / new_time))
+
+
+def Usage():
+    print("""Usage: DemToTopoBenchmark.py {DEM data folder} {Color Altitude File} {DEM file extension}
+                             [--repeat N] [--benchmark pipeline|merge|kernels|profiles|synthetic]
+                             [--terrain flat|mountain|nodata] [--size N] [--seed N] [--work-folder FOLDER]
+                             [--save FILE]
+
+    Runs the benchmarks for every DEM file in the folder, best of N runs (default 3).
+          pipeline times the disk based pipeline against the --in-memory pipeline.
+          merge times the scanline hsv_merge against the block hsv_merge and checks the output is identical,
+                and checks the LUT renderer is within one of it.
+          kernels times the float32 and fused HSV kernels against the reference on synthetic data,
+                  no DEM data is needed when only the kernels benchmark is run.
+          profiles times writing the _Topo.tif with each --topo-profile and compares the time and size with
+                   the uncompressed gtiff output.
+          synthetic generates DEMs of each --terrain and --size (default all terrains, 1024, 3601 and 10240
+                    pixels square) from --seed and times the full pipeline and each stage, in megapixels per
+                    second, with the peak memory. The DEM arguments are not needed, the Color Altitude File
+                    defaults to Data/ColorRelief02.txt. --work-folder keeps the generated DEMs for later runs.
+                    --save FILE appends the results to FILE, one JSON line per run, and compares them with
+                    the previous run in the file.
+    --benchmark, --terrain and --size can be given more than once. All benchmarks except synthetic run by
+    default.
+    """)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import hashlib
+import numpy
+import DemToTopoConsts
+
+# Parsed ramps by the sha256 of the colour file content, so a batch parses a
+# colour file once and a changed file is picked up on the next load.
+color_ramp_cache = {}
+
+
+# =============================================================================
+# ColorRamp
+#
+# A Color Altitude Value Map File. GDAL's color-relief reads the file itself,
+# so the entries are only parsed, and validated, when a table needs them.
+# Tables derived from the ramp (e.g. the topo lookup table) are built once
+# through get_table() and kept with the ramp, so every file of a batch and
+# every worker that is handed the ramp shares them.
+
+class ColorRamp:
+    def __init__(self, file_name, content):
+        self.file_name = file_name
+        self.content = content
+        self.content_hash = hashlib.sha256(content).hexdigest()
+        self.entries = None
+        self.tables = {}
+
+    def get_entries(self):
+        if self.entries is None:
+            self.entries = parse_color_ramp(self.content.decode(), self.file_name)
+        return self.entries
+
+    @property
+    def altitudes(self):
+        return self.get_entries()[0]
+
+    @property
+    def colors(self):
+        return self.get_entries()[1]
+
+    @property
+    def nodata_color(self):
+        return self.get_entries()[2]
+
+    def get_table(self, key, build):
+        if key not in self.tables:
+            self.tables[key] = build(self)
+        return self.tables[key]
+
+    def colors_at(self, values):
+        return ramp_colors(self.altitudes, self.colors, values)
+
+
+def load_color_ramp(color_altitude_file):
+    with open(color_altitude_file, 'rb') as file:
+        content = file.read()
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    if content_hash not in color_ramp_cache:
+        color_ramp_cache[content_hash] = ColorRamp(color_altitude_file, content)
+
+    return color_ramp_cache[content_hash]
+
+
+def add_color_ramp(color_ramp):
+    # Install a ramp built elsewhere, e.g. by the parent of a worker process.
+    color_ramp_cache[color_ramp.content_hash] = color_ramp
+
+
+def parse_color_ramp(text, file_name=''):
+    # Rows of altitude and colour in the syntax GDAL's color-relief reads:
+    # space, tab, comma or colon separated, # comment lines, 'nv' for the
+    # nodata colour, and the colour as red, green, blue (and alpha), a gray
+    # level (and alpha) or a colour name. Percentage altitudes depend on the
+    # DEM, so they can't be parsed into a ramp of the whole batch.
+    entries = []
+    nodata_color = None
+    for line_number, line in enumerate(text.splitlines(), 1):
+        fields = line.replace(',', ' ').replace('\t', ' ').replace(':', ' ').split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        try:
+            if len(fields) < 2:
+                raise ValueError('expected an altitude and a colour')
+            if fields[0].endswith('%'):
+                raise ValueError('percentage altitudes are relative to each DEM, only GDAL color-relief reads them')
+            color = parse_color(fields[1:])
+            if fields[0].lower() == 'nv':
+                nodata_color = color
+            else:
+                entries.append([float(fields[0])] + color)
+        except ValueError as e:
+            raise ValueError('Invalid colour ramp entry ' + file_name + ':' + str(line_number) + ': ' +
+                             line.strip() + ' (' + str(e) + ')')
+
+    if len(entries) < 2:
+        raise ValueError('Colour ramp ' + file_name + ' needs at least two altitude entries')
+
+    entries.sort(key=lambda entry: entry[0])
+    ramp = numpy.asarray(entries, dtype=numpy.float64)
+
+    return ramp[:, 0], ramp[:, 1:4], nodata_color
+
+
+def parse_color(fields):
+    # [red, green, blue] of the colour fields of an entry. Alpha is ignored,
+    # the topo image has no alpha band.
+    if len(fields) in (1, 2) and fields[0].lower() in DemToTopoConsts.COLOR_NAMES:
+        return list(DemToTopoConsts.COLOR_NAMES[fields[0].lower()])
+    if len(fields) in (1, 2):
+        color = [int(fields[0])] * 3
+    else:
+        color = [int(value) for value in fields[:3]]
+    if min(color) < 0 or max(color) > 255:
+        raise ValueError('colour values must be 0-255')
+    return color
+
+
+def ramp_colors(altitudes, colors, values):
+    # Linear interpolation between the ramp entries, clamped to the first and
+    # last colour, with the rounding GDAL's color-relief uses.
+    rgb = numpy.empty((len(values), 3), dtype=numpy.uint8)
+    for channel in range(3):
+        interpolated = numpy.interp(values, altitudes, colors[:, channel]) + 0.45
+        rgb[:, channel] = numpy.clip(interpolated, 0, 255).astype(numpy.uint8)
+
+    return rgb
@@ -6,6 +6,133 @@ SLOPE_WATER_EXT = '_SL_Water'
 SLOPE_POLY_EXT = '_SL_poly'
 TOPO_EXT = '_Topo'
 
+# Minimum water polygon area, square degrees, and the same area in square
+# metres at the equator for the latitude aware (geodesic) filter.
+WATER_MIN_AREA = 0.0000009
+WATER_MIN_AREA_M2 = 11078
+
 RED_VAL = 35
 GREEN_VAL = 170
-BLUE_VAL = 181
\ No newline at end of file
+BLUE_VAL = 181
+
+VSIMEM_FOLDER = '/vsimem/'
+
+# Pixels per window when streaming a raster in blocks (~32 MB as float64).
+STREAM_WINDOW_PIXELS = 4 * 1024 * 1024
+
+HSV_KERNELS = ['reference', 'float32', 'fused']
+
+# Altitude bin size of the topo lookup table, and bins merged per pass when building it.
+LUT_ALTITUDE_STEP = 1.0
+LUT_CHUNK_BINS = 1024
+
+RENDERERS = ['hsv', 'lut']
+
+# The colour names GDAL's color-relief accepts in a colour file.
+COLOR_NAMES = {'white': (255, 255, 255), 'black': (0, 0, 0), 'red': (255, 0, 0), 'green': (0, 255, 0),
+               'blue': (0, 0, 255), 'yellow': (255, 255, 0), 'magenta': (255, 0, 255), 'fuchsia': (255, 0, 255),
+               'cyan': (0, 255, 255), 'aqua': (0, 255, 255), 'grey': (190, 190, 190), 'gray': (190, 190, 190),
+               'orange': (255, 165, 0), 'violet': (238, 130, 238), 'purple': (160, 32, 240), 'none': (0, 0, 0)}
+
+# gdaldem parameters of the hillshade and slope stages.
+TERRAIN_SCALE = 111120
+HILL_SHADE_Z_FACTOR = 5
+HILL_SHADE_AZIMUTH = 90
+HILL_SHADE_ALTITUDE = 45
+SLOPE_NO_DATA_VALUE = -9999
+HILL_SHADE_NO_DATA_VALUE = 0
+
+TERRAIN_MODES = ['gdal', 'fused']
+
+MASK_CREATION_OPTIONS = ['NBITS=1']
+
+# Incremental runs: manifest file in the output folder, its format version,
+# the pipeline options that change the products, the hash read size and
+# the seconds between manifest saves during a batch.
+MANIFEST_FILE = 'DemToTopo_manifest.json'
+MANIFEST_VERSION = 2
+OUTPUT_OPTIONS = ['hsv_kernel', 'renderer', 'terrain', 'geodesic', 'topo_profile', 'tile_zoom']
+HASH_CHUNK_SIZE = 1024 * 1024
+MANIFEST_SAVE_INTERVAL = 10
+
+# Products are written to a staging folder inside the output folder and
+# moved into place when complete. Intermediate markers are cleaned up on start.
+STAGING_FOLDER = 'DemToTopo_staging/'
+SHAPEFILE_EXTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+INTERMEDIATE_EXTS = [COLOR_RELIEF_EXT, HILL_SHADE_EXT, SLOPE_EXT, SLOPE_HILL_SHADE_EXT, SLOPE_WATER_EXT]
+
+# Synthetic benchmark DEMs: SRTM like Int16 tiles of one degree, value noise
+# cells per side of the first relief and void octaves, and the lake level of
+# flat terrain in metres.
+SYNTHETIC_ORIGIN = [37, -1]
+SYNTHETIC_NO_DATA_VALUE = -32767
+SYNTHETIC_RELIEF_CELLS = 4
+SYNTHETIC_VOID_CELLS = 2
+SYNTHETIC_LAKE_LEVEL = 25
+SYNTHETIC_SIZES = [1024, 3601, 10240]
+
+# Library use: the process_dem_file options a Pipeline takes, and its folder
+# in /vsimem/.
+PIPELINE_OPTIONS = ['in_memory', 'stream', 'tile_size', 'hsv_kernel', 'renderer', 'terrain', 'geodesic',
+                    'topo_profile', 'threads', 'preview_size', 'preview_factor']
+PIPELINE_FOLDER = 'DemToTopoPipeline/'
+
+# _Topo.tif output profiles: driver and creation options. gtiff is the
+# original uncompressed stripped GTiff, written directly. The others get
+# overviews down to OVERVIEW_MIN_SIZE pixels, copied in with the image.
+TILED_GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER']
+TOPO_PROFILES = {'gtiff': ('GTiff', []),
+                 'deflate': ('GTiff', TILED_GTIFF_OPTIONS + ['COMPRESS=DEFLATE', 'PREDICTOR=2']),
+                 'zstd': ('GTiff', TILED_GTIFF_OPTIONS + ['COMPRESS=ZSTD', 'PREDICTOR=2']),
+                 'jpeg': ('GTiff', TILED_GTIFF_OPTIONS + ['COMPRESS=JPEG', 'PHOTOMETRIC=YCBCR', 'JPEG_QUALITY=90']),
+                 'cog': ('COG', ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BLOCKSIZE=512', 'BIGTIFF=IF_SAFER'])}
+TOPO_PROFILE_EXT = '_Profile'
+OVERVIEW_RESAMPLING = 'AVERAGE'
+OVERVIEW_MIN_SIZE = 256
+
+# Web map tiles: folder in the output folder, the per DEM tile parts in it,
+# the index of the tiles of each DEM and the MBTiles file. Tile size in
+# pixels, default and largest zoom levels and the warp resampling.
+TILES_FOLDER = 'DemToTopo_tiles/'
+TILE_PARTS_FOLDER = 'parts/'
+TILE_INDEX_FILE = 'index.json'
+MBTILES_FILE = 'DemToTopo.mbtiles'
+TILE_SCHEMES = ['xyz', 'tms', 'mbtiles']
+TILE_FORMATS = {'png': ('PNG', []), 'webp': ('WEBP', ['QUALITY=90'])}
+TILE_SIZE = 256
+TILE_ZOOM = [8, 12]
+TILE_MAX_ZOOM = 24
+TILE_RESAMPLING = 'bilinear'
+
+# Mosaic runs: default halo in pixels borrowed from the neighbouring tiles,
+# markers of the halo and cropped VRTs, the batch water layer in the output
+# folder and the equal area projection its lakes are measured in.
+MOSAIC_HALO = 1
+HALO_EXT = '_Halo'
+CROP_EXT = '_Crop'
+MOSAIC_WATER_FILE = 'DemToTopo_water.shp'
+EQUAL_AREA_EPSG = 6933
+
+# Batch water layer: OGR driver and layer creation options by file
+# extension, the layer name and square metres per hectare for its area.
+WATER_LAYER_FORMATS = {'.gpkg': ('GPKG', ['SPATIAL_INDEX=YES']),
+                       '.fgb': ('FlatGeobuf', ['SPATIAL_INDEX=YES'])}
+WATER_LAYER_NAME = 'water'
+SQUARE_METRES_PER_HECTARE = 10000
+
+# DEM discovery: files read ahead of the one being processed, and DEM files
+# in flight per worker process.
+PREFETCH_DEPTH = 1
+WORKER_QUEUE_FILES = 2
+
+# Memory mapped BIL DEMs: the pixel sizes in bits read without GDAL, and
+# the GDAL data type of each NumPy kind and size.
+RAW_DEM_NBITS = [8, 16, 32, 64]
+RAW_DEM_TYPES = {'u1': 'Byte', 'i1': 'Int8', 'u2': 'UInt16', 'i2': 'Int16', 'u4': 'UInt32', 'i4': 'Int32',
+                 'u8': 'UInt64', 'i8': 'Int64', 'f4': 'Float32', 'f8': 'Float64'}
+
+# Preview runs: products folder in the output folder, the marker of the
+# decimated DEM VRT and its resampling.
+PREVIEW_FOLDER = 'DemToTopo_preview/'
+PREVIEW_EXT = '_Preview'
+PREVIEW_RESAMPLING = 'average'
@@ -0,0 +1,154 @@
+import fnmatch
+import os
+import queue
+import threading
+import DemToTopoConsts
+from osgeo import gdal
+
+# Marks the end of the prefetch queue.
+END_OF_FILES = None
+
+
+# =============================================================================
+# iter_dem_files()
+#
+# Find the DEM files of a batch lazily, so processing starts with the first
+# file found rather than after the whole archive is listed. pattern is a
+# file extension (bil), as before, or a glob pattern matched against the
+# file names (s0*_e03*.bil, *.vrt). recursive walks the sub folders and
+# archives also looks inside .zip files, read in place through /vsizip/.
+#
+# Files are named relative to folder: sub/folder/name.bil, or for a file in
+# an archive archive.zip/name.bil. get_source_path() gives the GDAL path.
+
+def iter_dem_files(folder, pattern, recursive=False, archives=False):
+    for root, folders, file_names in os.walk(folder):
+        folders.sort()
+        relative_folder = os.path.relpath(root, folder)
+        prefix = '' if relative_folder == '.' else relative_folder.replace(os.sep, '/') + '/'
+        for file_name in sorted(file_names):
+            if matches(file_name, pattern):
+                yield prefix + file_name
+            elif archives and file_name.lower().endswith('.zip'):
+                for member in iter_archive(folder + prefix + file_name, pattern):
+                    yield prefix + file_name + '/' + member
+        if not recursive:
+            break
+
+
+def matches(file_name, pattern):
+    if any(character in pattern for character in '*?['):
+        return fnmatch.fnmatch(file_name, pattern)
+    return os.path.splitext(file_name)[1] == '.' + pattern
+
+
+def iter_archive(archive_name, pattern):
+    # The matching files in a zip archive, from its central directory.
+    for member in sorted(gdal.ReadDirRecursive('/vsizip/' + os.path.abspath(archive_name)) or []):
+        if not member.endswith('/') and matches(os.path.basename(member), pattern):
+            yield member
+
+
+def get_source_path(folder, file_name):
+    # The GDAL path of a file found by iter_dem_files().
+    index = file_name.lower().find('.zip/')
+    if index < 0:
+        return folder + file_name
+    return '/vsizip/' + os.path.abspath(folder + file_name[:index + 4]) + '/' + file_name[index + 5:]
+
+
+def split_source(folder, file_name):
+    # (folder, file name) of the GDAL path, the way process_dem_file() takes a DEM.
+    source_path = get_source_path(folder, file_name)
+    return os.path.dirname(source_path) + '/', os.path.basename(source_path)
+
+
+def get_file_list(folder, file_name):
+    # The GDAL paths of a file found by iter_dem_files() and of the sidecars
+    # GDAL reads with it (.hdr, .prj, .aux.xml, ...), sorted. Only the file
+    # itself when GDAL can't open it.
+    source_path = get_source_path(folder, file_name)
+    try:
+        dataset = gdal.Open(source_path)
+        file_list = dataset.GetFileList() if dataset is not None else None
+    except RuntimeError:
+        file_list = None
+    dataset = None
+    return sorted(set(file_list or []) | {source_path})
+
+
+def stat_source(source_path):
+    # (mtime in ns, size) of a GDAL path, a file in a .zip archive included.
+    if source_path.startswith('/vsizip/'):
+        stat = gdal.VSIStatL(source_path)
+        return stat.mtime * 1000000000, stat.size
+    stat = os.stat(source_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_chunks(source_path, chunk_size=DemToTopoConsts.HASH_CHUNK_SIZE):
+    # The bytes of a file or of a file in an archive, chunk by chunk.
+    if not source_path.startswith('/vsizip/'):
+        with open(source_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                yield chunk
+        return
+
+    file = gdal.VSIFOpenL(source_path, 'rb')
+    if file is None:
+        raise OSError('Cannot open ' + source_path)
+    try:
+        while True:
+            chunk = gdal.VSIFReadL(1, chunk_size, file)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        gdal.VSIFCloseL(file)
+
+
+# =============================================================================
+# prefetch()
+#
+# Yield file_names through a queue of up to depth files read ahead on a
+# thread. While a DEM is processed the next ones are read, so they are in
+# the page cache (or for an archive, the archive's pages) by the time the
+# stages open them. Finding and filtering the files runs on the thread too,
+# so the first file is processed as soon as it has been read. depth 0 reads
+# nothing ahead.
+
+def prefetch(folder, file_names, depth=DemToTopoConsts.PREFETCH_DEPTH):
+    if depth < 1:
+        yield from file_names
+        return
+
+    files = queue.Queue(maxsize=depth)
+    errors = []
+
+    def read_ahead():
+        try:
+            for file_name in file_names:
+                read_file(get_source_path(folder, file_name))
+                files.put(file_name)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            files.put(END_OF_FILES)
+
+    threading.Thread(target=read_ahead, daemon=True).start()
+    while True:
+        file_name = files.get()
+        if file_name is END_OF_FILES:
+            break
+        yield file_name
+    if errors:
+        raise errors[0]
+
+
+def read_file(source_path):
+    # Read and drop the bytes. A file that can't be read fails when processed.
+    try:
+        for chunk in read_chunks(source_path):
+            pass
+    except (OSError, RuntimeError):
+        pass
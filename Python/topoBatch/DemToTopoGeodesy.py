@@ -0,0 +1,79 @@
+import numpy
+import DemToTopoConsts
+import DemToTopoUtills
+from osgeo import osr
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+
+def is_geographic(dataset):
+    # A DEM without a projection is taken to be in degrees, like SRTM .bil tiles.
+    projection = dataset.GetProjection()
+    if not projection:
+        return True
+    spatial_ref = osr.SpatialReference()
+    spatial_ref.ImportFromWkt(projection)
+    return bool(spatial_ref.IsGeographic())
+
+
+def row_pixel_areas(geo_transform, rows, geographic=True):
+    # Ground area in square metres of one pixel of each row. Geographic rows
+    # use the exact area of the ellipsoid quadrangle between the row's
+    # latitudes; projected rasters are taken to be in metres.
+    if not geographic:
+        return numpy.full(rows, abs(geo_transform[1] * geo_transform[5]))
+
+    latitudes = numpy.radians(geo_transform[3] + numpy.arange(rows + 1) * geo_transform[5])
+    authalic = authalic_q(latitudes)
+    width = numpy.radians(abs(geo_transform[1]))
+
+    return WGS84_A * WGS84_A * (1 - WGS84_E2) * width / 2 * numpy.abs(numpy.diff(authalic))
+
+
+def authalic_q(latitudes):
+    e = numpy.sqrt(WGS84_E2)
+    sin_lat = numpy.sin(latitudes)
+    return (sin_lat / (1 - WGS84_E2 * sin_lat * sin_lat) +
+            numpy.log((1 + e * sin_lat) / (1 - e * sin_lat)) / (2 * e))
+
+
+def row_scales(geo_transform, rows, geographic=True):
+    # Metres per horizontal unit at the centre of each row, east-west and
+    # north-south, as (rows, 1) columns for the terrain kernel.
+    if not geographic:
+        return numpy.ones((rows, 1)), numpy.ones((rows, 1))
+
+    latitudes = numpy.radians(geo_transform[3] + (numpy.arange(rows) + 0.5) * geo_transform[5])
+    sin_lat = numpy.sin(latitudes)
+    w = numpy.sqrt(1 - WGS84_E2 * sin_lat * sin_lat)
+    ew_scale = numpy.radians(WGS84_A * numpy.cos(latitudes) / w)
+    ns_scale = numpy.radians(WGS84_A * (1 - WGS84_E2) / (w * w * w))
+
+    return ew_scale[:, numpy.newaxis], ns_scale[:, numpy.newaxis]
+
+
+def geometry_area(geometry):
+    # Ground area in square metres of a WGS84 (lon, lat) geometry, measured
+    # in the WGS84 cylindrical equal area projection.
+    projected = geometry.Clone()
+    projected.Transform(get_equal_area_transform())
+    return projected.GetArea()
+
+
+# The transformation to the equal area projection, created once per process.
+equal_area_transform = {}
+
+
+def get_equal_area_transform():
+    if 'transform' not in equal_area_transform:
+        source_srs = DemToTopoUtills.get_wgs84().Clone()
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromEPSG(DemToTopoConsts.EQUAL_AREA_EPSG)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        equal_area_transform['transform'] = osr.CoordinateTransformation(source_srs, target_srs)
+    return equal_area_transform['transform']
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import time
+import DemToTopoConsts
+import DemToTopoDiscovery
+
+
+# =============================================================================
+# Manifest
+#
+# JSON record, kept in the output folder, of every DEM processed: the hash
+# of the DEM and the sidecars GDAL reads with it (.hdr, .prj, .aux.xml, ...),
+# the name, mtime and size of each of those files, the colour ramp hash, the
+# processing parameters and the outputs produced. A DEM is unchanged when its
+# entry matches and its outputs still exist. The hash is only recomputed when
+# a file was added, removed or has another mtime or size, and a DEM touched
+# but not modified gets its new stats, so checking a large unchanged archive
+# costs opening each DEM and a stat per file. A DEM to be processed is stat
+# and hashed once, before it is processed, and recorded with those.
+# Files are named as iter_dem_files() finds them, files in .zip archives
+# included.
+
+class Manifest:
+    def __init__(self, folder):
+        self.file_name = folder + DemToTopoConsts.MANIFEST_FILE
+        self.entries = {}
+        self.hashes = {}
+        self.stats = {}
+        self.file_lists = {}
+        self.dirty = False
+        self.save_time = time.time()
+        if os.path.exists(self.file_name):
+            with open(self.file_name) as file:
+                manifest = json.load(file)
+            if manifest.get('version') == DemToTopoConsts.MANIFEST_VERSION:
+                self.entries = manifest['files']
+
+    def changed_files(self, folder, dem_file_list, color_hash, parameters):
+        return [file_name for file_name in dem_file_list
+                if not self.is_unchanged(folder, file_name, color_hash, parameters)]
+
+    def is_unchanged(self, folder, file_name, color_hash, parameters):
+        if self.check_unchanged(folder, file_name, color_hash, parameters):
+            return True
+        # To be processed, hash it now so record() doesn't read it again.
+        self.file_hash(folder, file_name)
+        return False
+
+    def check_unchanged(self, folder, file_name, color_hash, parameters):
+        entry = self.entries.get(file_name)
+        if entry is None:
+            return False
+        if entry['color_hash'] != color_hash or entry['parameters'] != parameters:
+            return False
+        if not all(os.path.exists(output) for output in entry['outputs']):
+            return False
+
+        stats = self.file_stat(folder, file_name)
+        if entry['stats'] == stats:
+            return True
+        # Touched but maybe not modified, compare the content.
+        if entry['hash'] != self.file_hash(folder, file_name):
+            return False
+        entry['stats'] = stats
+        self.dirty = True
+        return True
+
+    def record(self, folder, file_name, color_hash, parameters, outputs):
+        self.entries[file_name] = {'hash': self.file_hash(folder, file_name),
+                                   'stats': self.file_stat(folder, file_name),
+                                   'color_hash': color_hash,
+                                   'parameters': parameters,
+                                   'outputs': list(outputs)}
+        self.dirty = True
+
+    def save_if_due(self):
+        # Rewriting the whole manifest after every file of a large batch would
+        # cost more than the checks save, so save at most every few seconds.
+        if self.dirty and time.time() - self.save_time >= DemToTopoConsts.MANIFEST_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        # Write a temporary file and swap it in, a crash never leaves a torn manifest.
+        temp_file_name = self.file_name + '.tmp'
+        with open(temp_file_name, 'w') as file:
+            json.dump({'version': DemToTopoConsts.MANIFEST_VERSION, 'files': self.entries}, file, indent=1)
+        os.replace(temp_file_name, self.file_name)
+        self.dirty = False
+        self.save_time = time.time()
+
+    def file_list(self, folder, file_name):
+        if file_name not in self.file_lists:
+            self.file_lists[file_name] = DemToTopoDiscovery.get_file_list(folder, file_name)
+        return self.file_lists[file_name]
+
+    def file_stat(self, folder, file_name):
+        # [name, mtime, size] of each file, lists as they read back from JSON.
+        if file_name not in self.stats:
+            self.stats[file_name] = [[os.path.basename(source_path)] + list(DemToTopoDiscovery.stat_source(source_path))
+                                     for source_path in self.file_list(folder, file_name)]
+        return self.stats[file_name]
+
+    def file_hash(self, folder, file_name):
+        if file_name not in self.hashes:
+            self.hashes[file_name] = hash_files(self.file_list(folder, file_name))
+        return self.hashes[file_name]
+
+
+def hash_files(file_names):
+    # The names are hashed too, a renamed sidecar is a change.
+    digest = hashlib.sha256()
+    for file_name in file_names:
+        digest.update(os.path.basename(file_name).encode())
+        for chunk in DemToTopoDiscovery.read_chunks(file_name):
+            digest.update(chunk)
+    return digest.hexdigest()
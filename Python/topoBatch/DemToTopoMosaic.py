@@ -0,0 +1,261 @@
+import math
+import os
+import DemToTopoConsts
+import DemToTopoDiscovery
+import DemToTopoGeodesy
+import DemToTopoUtills
+import DemToTopoWaterLayer
+from osgeo import gdal, ogr
+from osgeo.gdalconst import *
+
+
+# =============================================================================
+# TileIndex
+#
+# Spatial index of the DEM tiles of a batch, built from their headers only.
+# Tiles are bucketed in a grid of cells the size of the largest tile, so the
+# neighbours of a tile are found from the few cells around it.
+
+class TileIndex:
+    def __init__(self, folder, dem_file_list):
+        self.folder = folder
+        self.geo_transforms = {}
+        self.bounds = {}
+        for file_name in dem_file_list:
+            ds_dem = gdal.Open(DemToTopoDiscovery.get_source_path(folder, file_name), GA_ReadOnly)
+            self.geo_transforms[file_name] = ds_dem.GetGeoTransform()
+            self.bounds[file_name] = get_bounds(ds_dem)
+            ds_dem = None
+
+        self.cell_size = max([max(east - west, north - south) for west, south, east, north in self.bounds.values()],
+                             default=1.0)
+        self.cells = {}
+        for file_name, bounds in self.bounds.items():
+            for cell in self.get_cells(bounds):
+                self.cells.setdefault(cell, []).append(file_name)
+
+    def get_cells(self, bounds):
+        west, south, east, north = bounds
+        for row in range(math.floor(south / self.cell_size), math.floor(north / self.cell_size) + 1):
+            for col in range(math.floor(west / self.cell_size), math.floor(east / self.cell_size) + 1):
+                yield col, row
+
+    def query(self, bounds):
+        # The tiles overlapping bounds.
+        found = set()
+        for cell in self.get_cells(bounds):
+            for file_name in self.cells.get(cell, []):
+                if overlaps(self.bounds[file_name], bounds):
+                    found.add(file_name)
+
+        return sorted(found)
+
+    def get_neighbours(self, file_name, halo):
+        # The other tiles within halo pixels of file_name.
+        geo_transform = self.geo_transforms[file_name]
+        return [neighbour for neighbour in self.query(expand_bounds(self.bounds[file_name], geo_transform, halo))
+                if neighbour != file_name]
+
+
+def get_bounds(ds_dem):
+    # (west, south, east, north)
+    geo_transform = ds_dem.GetGeoTransform()
+    return (geo_transform[0], geo_transform[3] + geo_transform[5] * ds_dem.RasterYSize,
+            geo_transform[0] + geo_transform[1] * ds_dem.RasterXSize, geo_transform[3])
+
+
+def overlaps(bounds, other_bounds):
+    return (bounds[0] < other_bounds[2] and other_bounds[0] < bounds[2] and
+            bounds[1] < other_bounds[3] and other_bounds[1] < bounds[3])
+
+
+def expand_bounds(bounds, geo_transform, halo):
+    return expand_sides(bounds, geo_transform, [halo] * 4)
+
+
+def expand_sides(bounds, geo_transform, margins):
+    # bounds grown by the (west, south, east, north) margins in pixels.
+    x_res = abs(geo_transform[1])
+    y_res = abs(geo_transform[5])
+    return (bounds[0] - x_res * margins[0], bounds[1] - y_res * margins[1],
+            bounds[2] + x_res * margins[2], bounds[3] + y_res * margins[3])
+
+
+def get_side_strip(bounds, geo_transform, halo, side):
+    # The halo pixels wide strip along one side (0 west, 1 south, 2 east, 3
+    # north) of bounds, outside them.
+    margins = [0, 0, 0, 0]
+    margins[side] = halo
+    strip = list(expand_sides(bounds, geo_transform, margins))
+    strip[(side + 2) % 4] = bounds[side]
+    return tuple(strip)
+
+
+# =============================================================================
+# create_halo_vrt()
+#
+# A VRT on the grid of the DEM, filled from the neighbouring tiles, given by
+# their GDAL paths. It is halo pixels larger only on the sides a neighbour
+# runs along: on the edge of the mosaic it ends with the DEM, so the terrain
+# stages treat that edge as the raster edge, as without --mosaic. Pixels of
+# the halo no tile covers, like the corner between two neighbours without a
+# diagonal one, read as the DEM's nodata value and are computed like an edge
+# (as 0 for a DEM without one).
+# Only the windows the terrain stages read are fetched from the neighbours,
+# nothing is mosaicked in memory. The DEM comes last so its own pixels win
+# where tiles overlap. Returns the VRT name and the window of the DEM in it.
+
+def create_halo_vrt(folder, file_name, neighbours, halo, vrt_name):
+    ds_dem = gdal.Open(folder + file_name, GA_ReadOnly)
+    geo_transform = ds_dem.GetGeoTransform()
+    bounds = get_bounds(ds_dem)
+    x_size = ds_dem.RasterXSize
+    y_size = ds_dem.RasterYSize
+    no_data_value = ds_dem.GetRasterBand(1).GetNoDataValue()
+    ds_dem = None
+
+    # (west, south, east, north) margins
+    margins = [0, 0, 0, 0]
+    for neighbour in neighbours:
+        ds_neighbour = gdal.Open(neighbour, GA_ReadOnly)
+        neighbour_bounds = get_bounds(ds_neighbour)
+        ds_neighbour = None
+        for side in range(4):
+            if overlaps(neighbour_bounds, get_side_strip(bounds, geo_transform, halo, side)):
+                margins[side] = halo
+    window = (margins[0], margins[3], x_size, y_size)
+
+    sources = list(neighbours) + [folder + file_name]
+    ds_vrt = gdal.BuildVRT(vrt_name, sources, outputBounds=expand_sides(bounds, geo_transform, margins),
+                           xRes=abs(geo_transform[1]), yRes=abs(geo_transform[5]),
+                           srcNodata=no_data_value, VRTNodata=no_data_value)
+    ds_vrt = None
+
+    DemToTopoUtills.print_dot()
+    return vrt_name, window
+
+
+def crop_to_window(file_name, window, vrt_name):
+    # VRT of the window of file_name, the DEM tile out of a halo raster.
+    ds_crop = gdal.Translate(vrt_name, file_name, format='VRT', srcWin=list(window))
+    ds_crop = None
+    return vrt_name
+
+
+# =============================================================================
+# merge_water()
+#
+# Batch water layer with the lakes that cross tile borders joined. The water
+# regions touching the halo edge are kept whatever their size when a tile is
+# processed, as only part of them is seen. Here the polygons touching a tile
+# border are unioned with the touching polygons of the neighbouring tiles,
+# and the joined lakes get the minimum area filter. Polygons inside a tile
+# were filtered with the tile and are copied. Returns the file name and the
+# water polygons by source, the tile or the comma separated tiles of a
+# joined lake.
+
+def merge_water(folder, tile_index, geodesic=False):
+    water = {}
+    border = {}
+    for file_name in sorted(tile_index.bounds):
+        geometries = DemToTopoWaterLayer.read_water(folder, file_name)
+        if geometries is None:
+            continue
+        border[file_name] = []
+        for geometry in geometries:
+            if touches_border(geometry, tile_index.bounds[file_name], tile_index.geo_transforms[file_name]):
+                border[file_name].append(geometry)
+            else:
+                water.setdefault(file_name, []).append(geometry)
+
+    min_area = DemToTopoConsts.WATER_MIN_AREA_M2 if geodesic else DemToTopoConsts.WATER_MIN_AREA
+    for sources, lake in join_border_polygons(border, tile_index):
+        if get_area(lake, geodesic) > min_area:
+            water.setdefault(sources, []).append(lake)
+
+    fn_water = folder + DemToTopoConsts.MOSAIC_WATER_FILE
+    write_polygons(fn_water, [geometry for geometries in water.values() for geometry in geometries])
+
+    DemToTopoUtills.print_dot()
+    return fn_water, water
+
+
+def touches_border(geometry, bounds, geo_transform):
+    # Within half a pixel of the tile edge.
+    min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+    x_tolerance = abs(geo_transform[1]) / 2
+    y_tolerance = abs(geo_transform[5]) / 2
+    return (min_x <= bounds[0] + x_tolerance or max_x >= bounds[2] - x_tolerance or
+            min_y <= bounds[1] + y_tolerance or max_y >= bounds[3] - y_tolerance)
+
+
+def join_border_polygons(border, tile_index):
+    # Union find over the border polygons, touching polygons of neighbouring
+    # tiles are joined. Only the polygons of neighbouring tiles are compared.
+    # Returns (sources, geometry) of every lake.
+    polygons = []
+    polygon_sources = []
+    first_polygon = {}
+    for file_name, geometries in border.items():
+        first_polygon[file_name] = len(polygons)
+        polygons += geometries
+        polygon_sources += [file_name] * len(geometries)
+    parents = list(range(len(polygons)))
+
+    def find(polygon):
+        while parents[polygon] != polygon:
+            parents[polygon] = parents[parents[polygon]]
+            polygon = parents[polygon]
+        return polygon
+
+    for file_name, geometries in border.items():
+        for neighbour in tile_index.get_neighbours(file_name, 1):
+            # each pair of tiles once
+            if neighbour not in border or neighbour <= file_name:
+                continue
+            for i, geometry in enumerate(geometries, first_polygon[file_name]):
+                for j, other in enumerate(border[neighbour], first_polygon[neighbour]):
+                    if geometry.Intersects(other):
+                        parents[find(i)] = find(j)
+
+    groups = {}
+    for polygon in range(len(polygons)):
+        groups.setdefault(find(polygon), []).append(polygon)
+
+    lakes = []
+    for group in groups.values():
+        sources = ','.join(sorted(set(polygon_sources[polygon] for polygon in group)))
+        if len(group) == 1:
+            lakes.append((sources, polygons[group[0]]))
+            continue
+        multi_polygon = ogr.Geometry(ogr.wkbMultiPolygon)
+        for polygon in group:
+            multi_polygon.AddGeometry(polygons[polygon])
+        lakes.append((sources, multi_polygon.UnionCascaded()))
+
+    return lakes
+
+
+def get_area(geometry, geodesic=False):
+    # Square degrees, or square metres.
+    if geodesic:
+        return DemToTopoGeodesy.geometry_area(geometry)
+    return geometry.GetArea()
+
+
+def write_polygons(fn_water, geometries):
+    driver_file = DemToTopoUtills.get_vector_driver("ESRI Shapefile")
+    if os.path.exists(fn_water):
+        driver_file.DeleteDataSource(fn_water)
+
+    out_datasource_file = driver_file.CreateDataSource(fn_water)
+    out_layer_file = out_datasource_file.CreateLayer("water", DemToTopoUtills.get_wgs84(), geom_type=ogr.wkbPolygon)
+    layer_definition = out_layer_file.GetLayerDefn()
+    for geometry in geometries:
+        feature = ogr.Feature(layer_definition)
+        feature.SetGeometry(geometry)
+        out_layer_file.CreateFeature(feature)
+        feature = None
+
+    out_layer_file = None
+    out_datasource_file = None
@@ -0,0 +1,51 @@
+import os
+import DemToTopoConsts
+import DemToTopoUtills
+from osgeo import gdal
+from osgeo.gdalconst import *
+
+
+# =============================================================================
+# write_topo()
+#
+# Write the rendered _Topo image with an output profile: tiled and DEFLATE,
+# ZSTD or JPEG (YCbCr) compressed GTiff with internal overviews, or a Cloud
+# Optimized GeoTIFF. The image is rendered, water included, uncompressed,
+# then the overviews are built from it and the product is written with one
+# CreateCopy that lays out the overviews with the full resolution, so no
+# gdaladdo pass over the compressed product is needed.
+# fn_render is removed, fn_topo can be the same file.
+
+def write_topo(fn_render, fn_topo, profile):
+    driver_name, options = DemToTopoConsts.TOPO_PROFILES[profile]
+    if fn_topo == fn_render:
+        fn_copy = os.path.splitext(fn_topo)[0] + DemToTopoConsts.TOPO_PROFILE_EXT + '.tif'
+    else:
+        fn_copy = fn_topo
+
+    ds_render = gdal.Open(fn_render, GA_Update)
+    levels = get_overview_levels(ds_render.RasterXSize, ds_render.RasterYSize)
+    if levels:
+        ds_render.BuildOverviews(DemToTopoConsts.OVERVIEW_RESAMPLING, levels)
+
+    ds_topo = DemToTopoUtills.get_driver(driver_name).CreateCopy(fn_copy, ds_render, strict=0, options=options)
+    ds_topo = None
+    ds_render = None
+
+    DemToTopoUtills.remove_file(fn_render)
+    if fn_copy != fn_topo:
+        DemToTopoUtills.rename_file(fn_copy, fn_topo)
+
+    DemToTopoUtills.print_dot()
+    return fn_topo
+
+
+def get_overview_levels(x_size, y_size):
+    # Factors 2, 4, 8, ... while the overview is at least OVERVIEW_MIN_SIZE.
+    levels = []
+    factor = 2
+    while min(x_size, y_size) // factor >= DemToTopoConsts.OVERVIEW_MIN_SIZE:
+        levels.append(factor)
+        factor *= 2
+
+    return levels
@@ -0,0 +1,141 @@
+import itertools
+import os
+import numpy
+import DemToTopo
+import DemToTopoColorRamp
+import DemToTopoConsts
+import DemToTopoUtills
+import DemToTopo_LUT_Render
+from osgeo import gdal, gdal_array, ogr
+
+# Numbers the /vsimem/ folders of the pipelines of a process.
+pipeline_numbers = itertools.count()
+
+
+# =============================================================================
+# Pipeline
+#
+# DemToTopo as a library. A Pipeline is set up once, with the colour ramp,
+# the process_dem_file options and the output folder, and then processes any
+# number of DEMs given as a file path, an open gdal.Dataset or a NumPy array
+# with its geotransform. The colour ramp and its tables, the GDAL drivers and
+# the WGS84 spatial reference stay loaded between calls.
+#
+# Without an output folder the products are made in /vsimem/ and returned in
+# memory: the topographic image as a (bands, rows, columns) uint8 array and
+# the water areas as OGR geometries. With one they are written there, as the
+# batch does, and the result holds their file names.
+#
+#   with DemToTopoPipeline.Pipeline('ColorRelief02.txt', terrain='fused') as pipeline:
+#       result = pipeline.process(dem_array, geo_transform)
+
+class Pipeline:
+    def __init__(self, color_altitude_file, out_folder=None, water=True, **options):
+        unknown = set(options) - set(DemToTopoConsts.PIPELINE_OPTIONS)
+        if unknown:
+            raise ValueError('Unknown pipeline options: ' + ', '.join(sorted(unknown)))
+
+        if isinstance(color_altitude_file, DemToTopoColorRamp.ColorRamp):
+            self.color_ramp = color_altitude_file
+        else:
+            self.color_ramp = DemToTopoColorRamp.load_color_ramp(color_altitude_file)
+        if options.get('renderer') == 'lut':
+            DemToTopo_LUT_Render.get_topo_lut(self.color_ramp)
+
+        self.options = dict(options, water=water)
+        self.out_folder = out_folder
+        self.memory_folder = (DemToTopoConsts.VSIMEM_FOLDER + DemToTopoConsts.PIPELINE_FOLDER +
+                              str(next(pipeline_numbers)) + '/')
+        self.source_numbers = itertools.count()
+
+        DemToTopoUtills.configure_gdal(options.get('threads', 1))
+        DemToTopoUtills.get_driver('GTiff')
+        DemToTopoUtills.get_vector_driver('ESRI Shapefile')
+        DemToTopoUtills.get_wgs84_esri_wkt()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        DemToTopoUtills.remove_folder(self.memory_folder)
+
+    def process(self, source, geo_transform=None, projection=None, no_data_value=None, name=None):
+        # source is a DEM file path, a gdal.Dataset or a 2D NumPy array. An
+        # array needs its geo_transform and is taken to be WGS84 unless a
+        # projection (WKT) is given. name names the products of a dataset
+        # or array.
+        if isinstance(source, str):
+            folder, file_name = os.path.split(source)
+            return self.run(os.path.join(folder, ''), file_name)
+
+        source_folder = self.memory_folder + 'source/'
+        file_name = (name or 'dem_' + str(next(self.source_numbers))) + '.tif'
+        if isinstance(source, numpy.ndarray):
+            if geo_transform is None:
+                raise ValueError('A DEM array needs its geo_transform')
+            dataset = create_source(source_folder + file_name, source, geo_transform,
+                                    projection or DemToTopoUtills.get_wgs84().ExportToWkt(), no_data_value)
+        else:
+            dataset = DemToTopoUtills.get_driver('GTiff').CreateCopy(source_folder + file_name, source)
+        dataset = None
+
+        try:
+            return self.run(source_folder, file_name)
+        finally:
+            DemToTopoUtills.remove_file(source_folder + file_name)
+
+    def run(self, folder, file_name):
+        out_folder = self.out_folder or self.memory_folder
+        out_topo_name, out_vector_water = DemToTopo.process_dem_file(folder, file_name, self.color_ramp.file_name,
+                                                                     out_folder=out_folder,
+                                                                     color_ramp=self.color_ramp, **self.options)
+        if self.out_folder:
+            return TopoResult(topo_file=out_topo_name, water_file=out_vector_water)
+
+        try:
+            return read_result(out_topo_name, out_vector_water)
+        finally:
+            for product_name in DemToTopo.get_product_names(out_folder, file_name):
+                if DemToTopoUtills.file_exists(product_name):
+                    DemToTopoUtills.remove_file(product_name)
+
+
+class TopoResult:
+    def __init__(self, topo=None, geo_transform=None, projection=None, water=None, topo_file=None,
+                 water_file=None):
+        self.topo = topo
+        self.geo_transform = geo_transform
+        self.projection = projection
+        self.water = water
+        self.topo_file = topo_file
+        self.water_file = water_file
+
+
+def create_source(file_name, dem, geo_transform, projection, no_data_value=None):
+    data_type = gdal_array.NumericTypeCodeToGDALTypeCode(dem.dtype)
+    dataset = DemToTopoUtills.get_driver('GTiff').Create(file_name, dem.shape[1], dem.shape[0], 1, data_type)
+    dataset.SetGeoTransform(list(geo_transform))
+    dataset.SetProjection(projection)
+    band = dataset.GetRasterBand(1)
+    if no_data_value is not None:
+        band.SetNoDataValue(no_data_value)
+    band.WriteArray(dem)
+
+    band = None
+    return dataset
+
+
+def read_result(out_topo_name, out_vector_water):
+    ds_topo = gdal.Open(out_topo_name)
+    result = TopoResult(ds_topo.ReadAsArray(), ds_topo.GetGeoTransform(), ds_topo.GetProjection())
+    ds_topo = None
+
+    if out_vector_water is not None:
+        ds_vector_water = ogr.Open(out_vector_water)
+        result.water = [feature.GetGeometryRef().Clone() for feature in ds_vector_water.GetLayer()]
+        ds_vector_water = None
+
+    return result
@@ -0,0 +1,40 @@
+import math
+import DemToTopoConsts
+import DemToTopoUtills
+from osgeo import gdal
+from osgeo.gdalconst import *
+
+
+# =============================================================================
+# create_preview_vrt()
+#
+# A VRT of the DEM decimated by a whole factor, for a quick look at a colour
+# ramp or the texture weights. The stages read it like the DEM. GDAL reads a
+# decimated window from the DEM's overviews when it has them, and averages
+# the full resolution pixels on read otherwise, so the full DEM is never
+# loaded. The water area filter is in ground units (square degrees or
+# square metres), so fewer, larger preview pixels make up a water body
+# without changing the threshold. Returns the VRT name.
+
+def create_preview_vrt(scr_dem, preview_size, preview_factor, vrt_name):
+    ds_dem = gdal.Open(scr_dem, GA_ReadOnly)
+    x_size = ds_dem.RasterXSize
+    y_size = ds_dem.RasterYSize
+    ds_dem = None
+
+    factor = get_preview_factor(x_size, y_size, preview_size, preview_factor)
+    ds_vrt = gdal.Translate(vrt_name, scr_dem, format='VRT', width=math.ceil(x_size / factor),
+                            height=math.ceil(y_size / factor), resampleAlg=DemToTopoConsts.PREVIEW_RESAMPLING)
+    ds_vrt = None
+
+    DemToTopoUtills.print_dot()
+    return vrt_name
+
+
+def get_preview_factor(x_size, y_size, preview_size=None, preview_factor=None):
+    # The smallest whole factor that is at least preview_factor and brings
+    # the larger side down to preview_size pixels.
+    factor = max(1, preview_factor or 1)
+    if preview_size:
+        factor = max(factor, math.ceil(max(x_size, y_size) / preview_size))
+    return factor
@@ -0,0 +1,158 @@
+import csv
+import contextlib
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Stage records of the file being processed, None when not collecting.
+stages = None
+
+STAGE_FIELDS = ['stage', 'wall_time', 'cpu_time', 'peak_rss', 'read_bytes', 'written_bytes']
+
+
+# =============================================================================
+# Stage instrumentation
+#
+# Each pipeline step runs inside stage(name), which records its wall time,
+# the CPU time of the process, the peak resident set size during the step
+# and the bytes read and written through the file system (Linux
+# /proc/self/io, so GDAL's /vsimem/ is not counted). The peak is reset when
+# the step starts (Linux /proc/self/clear_refs); where it can't be, it is the
+# peak of the process so far. Measurements that the platform does not
+# provide are None.
+
+def start():
+    global stages
+    stages = []
+
+
+def finish():
+    global stages
+    file_stages = stages
+    stages = None
+    return file_stages
+
+
+@contextlib.contextmanager
+def stage(name):
+    if stages is None:
+        yield
+        return
+
+    read_bytes, written_bytes = io_counters()
+    peak_reset = reset_peak_rss()
+    wall_time = time.perf_counter()
+    cpu_time = time.process_time()
+    try:
+        yield
+    finally:
+        end_read_bytes, end_written_bytes = io_counters()
+        stages.append({'stage': name,
+                       'wall_time': time.perf_counter() - wall_time,
+                       'cpu_time': time.process_time() - cpu_time,
+                       'peak_rss': stage_peak_rss() if peak_reset else peak_rss(),
+                       'read_bytes': difference(end_read_bytes, read_bytes),
+                       'written_bytes': difference(end_written_bytes, written_bytes)})
+
+
+def reset_peak_rss():
+    # Reset the high-water mark of the resident set size. True when it was.
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def stage_peak_rss():
+    # Bytes, the high-water mark since reset_peak_rss().
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return peak_rss()
+
+
+def peak_rss():
+    # Bytes, the peak of the process. ru_maxrss is in kilobytes on Linux and
+    # bytes on macOS.
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def io_counters():
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def difference(end, start_value):
+    if end is None or start_value is None:
+        return None
+    return end - start_value
+
+
+# =============================================================================
+# Report
+#
+# results are (file_name, process_time, error, outputs, stages) tuples. The
+# summary adds up each stage over the batch, peak_rss being the largest seen.
+
+def summarize(results):
+    summary = {}
+    for result in results:
+        for file_stage in result[4] or []:
+            total = summary.setdefault(file_stage['stage'], {'stage': file_stage['stage'], 'count': 0,
+                                                             'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss': None,
+                                                             'read_bytes': None, 'written_bytes': None})
+            total['count'] += 1
+            total['wall_time'] += file_stage['wall_time']
+            total['cpu_time'] += file_stage['cpu_time']
+            if file_stage['peak_rss'] is not None:
+                total['peak_rss'] = max(total['peak_rss'] or 0, file_stage['peak_rss'])
+            for field in ['read_bytes', 'written_bytes']:
+                if file_stage[field] is not None:
+                    total[field] = (total[field] or 0) + file_stage[field]
+
+    return list(summary.values())
+
+
+def write_report(report_file, results):
+    # JSON or CSV by the file extension.
+    if report_file.lower().endswith('.csv'):
+        write_csv_report(report_file, results)
+    else:
+        write_json_report(report_file, results)
+
+
+def write_json_report(report_file, results):
+    files = [{'file': file_name, 'process_time': process_time, 'error': error, 'stages': file_stages or []}
+             for file_name, process_time, error, outputs, file_stages in results]
+    with open(report_file, 'w') as file:
+        json.dump({'files': files, 'summary': summarize(results)}, file, indent=1)
+
+
+def write_csv_report(report_file, results):
+    # One row per file and stage, then the batch summary with file '*'.
+    with open(report_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, ['file', 'count'] + STAGE_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for file_name, process_time, error, outputs, file_stages in results:
+            for file_stage in file_stages or []:
+                writer.writerow(dict(file_stage, file=file_name, count=1))
+        for total in summarize(results):
+            writer.writerow(dict(total, file='*'))
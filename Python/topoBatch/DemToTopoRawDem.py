@@ -0,0 +1,119 @@
+import os
+import sys
+import numpy
+import DemToTopoConsts
+from osgeo import gdal
+
+
+# =============================================================================
+# RawDem
+#
+# Fast path for ESRI BIL DEMs, like the SRTM .bil tiles with a .hdr. The .hdr
+# is parsed and the .bil is mapped with numpy.memmap, so a window of the DEM
+# is a view of the page cache instead of a copy read through GDAL. The values
+# keep the byte order of the file (BYTEORDER I or M) and are converted only
+# when a stage computes with them. Header values default the way the ESRI
+# format does. bands holds a (rows, columns) view per band. The geotransform
+# and nodata value are GDAL's, which also reads the .blw and .aux.xml.
+
+class RawDem:
+    def __init__(self, file_name, header):
+        self.file_name = file_name
+        self.x_size = int(header['NCOLS'])
+        self.y_size = int(header['NROWS'])
+        self.band_count = int(header.get('NBANDS', 1))
+        dtype = get_dtype(header)
+
+        band_row_bytes = int(header.get('BANDROWBYTES', self.x_size * dtype.itemsize))
+        total_row_bytes = int(header.get('TOTALROWBYTES', band_row_bytes * self.band_count))
+        rows = numpy.memmap(file_name, numpy.uint8, 'r', int(header.get('SKIPBYTES', 0)),
+                            (self.y_size, total_row_bytes))
+        # Each band is a view of its part of every row, gaps between the rows
+        # and bands are skipped by the strides.
+        self.dtype = dtype
+        self.bands = [rows[:, band * band_row_bytes:band * band_row_bytes + self.x_size * dtype.itemsize].view(dtype)
+                      for band in range(self.band_count)]
+
+    def get_band(self, band=1, no_data_value=None):
+        return RawBand(self, self.bands[band - 1], no_data_value)
+
+
+# =============================================================================
+# RawBand
+#
+# The part of a GDAL band a stage reads the DEM through. ReadAsArray returns
+# a view of the mapped file, which must not be written to.
+
+class RawBand:
+    def __init__(self, raw_dem, array, no_data_value=None):
+        self.raw_dem = raw_dem
+        self.array = array
+        self.no_data_value = no_data_value
+        self.XSize = raw_dem.x_size
+        self.YSize = raw_dem.y_size
+
+    def GetNoDataValue(self):
+        return self.no_data_value
+
+    def ReadAsArray(self, x_off=0, y_off=0, x_size=None, y_size=None):
+        x_size = self.XSize - x_off if x_size is None else x_size
+        y_size = self.YSize - y_off if y_size is None else y_size
+        return self.array[y_off:y_off + y_size, x_off:x_off + x_size]
+
+
+def open_raw_dem(file_name):
+    # A RawDem of a BIL file on disk, or None when the file has to be read
+    # through GDAL: other formats, files in /vsi file systems (VRTs of a
+    # mosaic, /vsizip/, /vsimem/), BIP and BSQ layouts and sub byte pixels.
+    if file_name.startswith('/vsi') or os.path.splitext(file_name)[1].lower() != '.bil':
+        return None
+    header = read_header(os.path.splitext(file_name)[0] + '.hdr')
+    if header is None or header.get('LAYOUT', 'BIL').upper() != 'BIL':
+        return None
+    if int(header.get('NBITS', 8)) not in DemToTopoConsts.RAW_DEM_NBITS:
+        return None
+
+    return RawDem(file_name, header)
+
+
+def open_raw_band(file_name, gdal_band):
+    # Band 1 of the BIL with the nodata value of the band GDAL reads, when it
+    # has the same size and data type. Otherwise the header is read
+    # differently from GDAL and the band is read through GDAL.
+    raw_dem = open_raw_dem(file_name)
+    if raw_dem is None or (raw_dem.x_size, raw_dem.y_size) != (gdal_band.XSize, gdal_band.YSize):
+        return None
+    data_type = DemToTopoConsts.RAW_DEM_TYPES.get(raw_dem.dtype.kind + str(raw_dem.dtype.itemsize))
+    if data_type != gdal.GetDataTypeName(gdal_band.DataType):
+        return None
+    return raw_dem.get_band(1, gdal_band.GetNoDataValue())
+
+
+def read_header(fn_hdr):
+    # Keyword value pairs, keywords upper case. None without a header.
+    if not os.path.exists(fn_hdr):
+        return None
+
+    header = {}
+    with open(fn_hdr) as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) >= 2:
+                header[fields[0].upper()] = fields[1]
+    return header
+
+
+def get_dtype(header):
+    # The byte order defaults to the host's, as in the ESRI format.
+    nbits = int(header.get('NBITS', 8))
+    pixel_type = header.get('PIXELTYPE', 'UNSIGNEDINT').upper()
+    if pixel_type == 'FLOAT':
+        kind = 'f'
+    elif pixel_type == 'SIGNEDINT':
+        kind = 'i'
+    else:
+        kind = 'u'
+
+    byte_order = header.get('BYTEORDER', 'I' if sys.byteorder == 'little' else 'M').upper()
+    return numpy.dtype(('<' if byte_order in ('I', 'L', 'LSBFIRST') else '>') + kind + str(nbits // 8))
+
@@ -0,0 +1,110 @@
+import numpy
+import DemToTopoUtills
+
+
+# =============================================================================
+# Connected regions of a 0/1 mask, 4-connected like gdal.Polygonize.
+#
+# The mask is reduced to runs of 1 pixels per row (rows, starts, ends), runs
+# that overlap on neighbouring rows are joined with a vectorised union find,
+# so the regions can be measured and filtered before anything is polygonized.
+
+def read_runs(band):
+    # Runs of the whole band, read in full width stripes so the memory used is
+    # the runs themselves rather than the raster.
+    window_x_size, window_y_size = DemToTopoUtills.get_window_size(band, True)
+    runs = [mask_runs(band.ReadAsArray(*window), window[1])
+            for window, _ in DemToTopoUtills.get_windows(band.XSize, band.YSize, window_x_size, window_y_size)]
+
+    return tuple(numpy.concatenate(values) for values in zip(*runs))
+
+
+def mask_runs(mask_block, row_offset=0):
+    padded = numpy.zeros((mask_block.shape[0], mask_block.shape[1] + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask_block != 0
+    edges = numpy.diff(padded, axis=1)
+
+    rows, starts = numpy.nonzero(edges == 1)
+    ends = numpy.nonzero(edges == -1)[1]
+
+    return rows + row_offset, starts, ends
+
+
+def label_runs(rows, starts, ends, width):
+    # Returns the region label (the index of its first run) of every run.
+    run_count = len(rows)
+    labels = numpy.arange(run_count)
+    if run_count == 0:
+        return labels
+
+    # Runs are in row major order, so row * (width + 1) + column is sorted for
+    # both the starts and the ends. Run j touches the runs i on the row above
+    # with start_i < end_j and end_i > start_j.
+    row_above = (rows - 1) * (width + 1)
+    lo = numpy.searchsorted(rows * (width + 1) + ends, row_above + starts, side='right')
+    hi = numpy.searchsorted(rows * (width + 1) + starts, row_above + ends, side='left')
+    counts = numpy.maximum(hi - lo, 0)
+
+    run_j = numpy.repeat(numpy.arange(run_count), counts)
+    first_pair = numpy.cumsum(counts) - counts
+    run_i = numpy.repeat(lo, counts) + numpy.arange(len(run_j)) - numpy.repeat(first_pair, counts)
+
+    # Hook the larger root onto the smaller one and compress until every pair
+    # of touching runs shares a root.
+    while True:
+        root_i = labels[run_i]
+        root_j = labels[run_j]
+        unjoined = root_i != root_j
+        if not unjoined.any():
+            return labels
+        numpy.minimum.at(labels, numpy.maximum(root_i[unjoined], root_j[unjoined]),
+                         numpy.minimum(root_i[unjoined], root_j[unjoined]))
+        while True:
+            compressed = labels[labels]
+            if numpy.array_equal(compressed, labels):
+                break
+            labels = compressed
+
+
+def region_sizes(labels, run_weights):
+    # Total weight (pixel count, area, ...) of the region of every run.
+    return numpy.bincount(labels, weights=run_weights, minlength=len(labels))[labels]
+
+
+def paint_runs(rows, starts, ends, window):
+    # 0/1 uint8 block of the runs that fall in window (x_off, y_off, x_size, y_size).
+    first = numpy.searchsorted(rows, window[1], side='left')
+    last = numpy.searchsorted(rows, window[1] + window[3], side='left')
+    rows = rows[first:last] - window[1]
+    starts = numpy.clip(starts[first:last] - window[0], 0, window[2])
+    ends = numpy.clip(ends[first:last] - window[0], 0, window[2])
+
+    size = window[3] * (window[2] + 1)
+    edges = (numpy.bincount(rows * (window[2] + 1) + starts, minlength=size) -
+             numpy.bincount(rows * (window[2] + 1) + ends, minlength=size))
+    edges = edges.reshape(window[3], window[2] + 1)
+
+    return (numpy.cumsum(edges, axis=1)[:, :-1] > 0).view(numpy.uint8)
+
+
+def sieve_mask(band, min_area, row_areas, keep_edges=False):
+    # Clear the regions of band with an area of min_area or less, in place.
+    # row_areas is the area of one pixel of each row. keep_edges keeps the
+    # regions touching the raster edge whatever their size, as they may carry
+    # on beyond it. Returns the number of regions kept.
+    rows, starts, ends = read_runs(band)
+    labels = label_runs(rows, starts, ends, band.XSize)
+    keep = region_sizes(labels, (ends - starts) * row_areas[rows]) > min_area
+    if keep_edges:
+        edge_regions = numpy.zeros(len(labels), dtype=bool)
+        edge_regions[labels[(rows == 0) | (rows == band.YSize - 1) | (starts == 0) | (ends == band.XSize)]] = True
+        keep |= edge_regions[labels]
+    write_runs(band, rows[keep], starts[keep], ends[keep])
+
+    return len(numpy.unique(labels[keep]))
+
+
+def write_runs(band, rows, starts, ends):
+    window_x_size, window_y_size = DemToTopoUtills.get_window_size(band, True)
+    for window, _ in DemToTopoUtills.get_windows(band.XSize, band.YSize, window_x_size, window_y_size):
+        band.WriteArray(paint_runs(rows, starts, ends, window), window[0], window[1])
@@ -0,0 +1,108 @@
+import numpy
+import DemToTopoConsts
+import DemToTopoUtills
+
+from osgeo.gdalconst import *
+
+
+# =============================================================================
+# Synthetic DEMs
+#
+# Reproducible test terrain for the benchmarks, written like an SRTM 1 arc
+# second tile: an Int16 EHdr .bil in WGS84 with -32767 as nodata.
+#
+#   flat      low relief plains rounded to whole metres, with lakes at one
+#             level, so a large part of the tile is water.
+#   mountain  rough fractal mountains up to about 4500 m.
+#   nodata    mountains with large voids and scattered nodata pixels.
+#
+# The terrain is value noise, random grids of a few octaves interpolated to
+# the tile size. Each octave's grid is interpolated along the columns once and
+# along the rows stripe by stripe, so a 10k x 10k tile is written without
+# holding it in memory. The same terrain, size and seed give the same tile.
+
+TERRAINS = ['flat', 'mountain', 'nodata']
+
+
+def create_synthetic_dem(file_name, terrain, size, seed=0):
+    rng = numpy.random.default_rng([seed, TERRAINS.index(terrain), size])
+    relief = noise_octaves(rng, size, DemToTopoConsts.SYNTHETIC_RELIEF_CELLS)
+    voids = noise_octaves(rng, size, DemToTopoConsts.SYNTHETIC_VOID_CELLS) if terrain == 'nodata' else None
+
+    driver = DemToTopoUtills.get_driver('EHdr')
+    dataset = driver.Create(file_name, size, size, 1, GDT_Int16)
+    pixel_size = 1.0 / (size - 1)
+    dataset.SetGeoTransform([DemToTopoConsts.SYNTHETIC_ORIGIN[0] - pixel_size / 2, pixel_size, 0,
+                             DemToTopoConsts.SYNTHETIC_ORIGIN[1] + pixel_size / 2, 0, -pixel_size])
+    dataset.SetProjection(DemToTopoUtills.get_wgs84().ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(DemToTopoConsts.SYNTHETIC_NO_DATA_VALUE)
+
+    stripe_rows = max(1, DemToTopoConsts.STREAM_WINDOW_PIXELS // size)
+    for y_off in range(0, size, stripe_rows):
+        rows = numpy.arange(y_off, min(y_off + stripe_rows, size))
+        band.WriteArray(terrain_rows(terrain, rng, relief, voids, rows, size), 0, y_off)
+
+    band = None
+    dataset = None
+    return file_name
+
+
+def terrain_rows(terrain, rng, relief, voids, rows, size):
+    height = octave_rows(relief, rows, size)
+
+    if terrain == 'flat':
+        # 0-60 m plains, everything below the lake level is one flat surface.
+        elevation = numpy.maximum(height * 60, DemToTopoConsts.SYNTHETIC_LAKE_LEVEL)
+    else:
+        # Ridged noise for sharp crests, plus one metre of pixel noise.
+        elevation = (1 - numpy.abs(2 * height - 1)) ** 2 * 4500 + rng.normal(0, 1, height.shape)
+    elevation = numpy.rint(elevation).astype(numpy.int16)
+
+    if terrain == 'nodata':
+        no_data = (octave_rows(voids, rows, size) > 0.6) | (rng.random(elevation.shape) < 0.01)
+        elevation[no_data] = DemToTopoConsts.SYNTHETIC_NO_DATA_VALUE
+
+    return elevation
+
+
+def noise_octaves(rng, size, cells):
+    # One (amplitude, grid) per octave, cells, 2 * cells, ... per side, up to
+    # one cell per 8 pixels. Grids come back interpolated along the columns.
+    octaves = []
+    amplitude = 1.0
+    while cells <= size // 8:
+        grid = rng.random((cells + 1, cells + 1), dtype=numpy.float32)
+        octaves.append((amplitude, interpolate_axis(grid, size, 1).astype(numpy.float32)))
+        amplitude /= 2
+        cells *= 2
+
+    return octaves
+
+
+def octave_rows(octaves, rows, size):
+    # Sum of the octaves for rows, normalised to 0-1.
+    total = 0.0
+    height = 0.0
+    for amplitude, grid in octaves:
+        height = height + amplitude * interpolate_axis(grid, size, 0, rows)
+        total += amplitude
+
+    return height / total
+
+
+def interpolate_axis(grid, size, axis, positions=None):
+    # Linear interpolation of grid spread over size pixels along axis,
+    # optionally only at the pixel positions given.
+    if positions is None:
+        positions = numpy.arange(size)
+    coordinates = positions * (grid.shape[axis] - 1) / max(size - 1, 1)
+    index = numpy.minimum(coordinates.astype(numpy.int64), grid.shape[axis] - 2)
+    weight = coordinates - index
+
+    low = numpy.take(grid, index, axis)
+    high = numpy.take(grid, index + 1, axis)
+    if axis == 0:
+        weight = weight[:, numpy.newaxis]
+
+    return low * (1 - weight) + high * weight
@@ -0,0 +1,163 @@
+import numpy
+import DemToTopoConsts
+import DemToTopoGeodesy
+import DemToTopoRawDem
+import DemToTopoUtills
+from osgeo import gdal
+from osgeo.gdalconst import *
+
+
+# =============================================================================
+# create_terrain()
+#
+# Fused replacement for create_hill_shade(), create_slope(),
+# create_slope_hill_shade() and create_slope_water(). The DEM is read once,
+# window by window with a one pixel halo, and the slope, hillshade, slope
+# hillshade texture and flat water mask are computed in one pass. Only the
+# _SL_HS and _SL_Water rasters are written, in the same format as the GDAL
+# based stages produce them. geodesic replaces the fixed scale with the
+# ground distance of a degree at the latitude of each row. threads computes
+# that many windows at a time. A BIL DEM is read from a memory map of the
+# file instead of through GDAL.
+
+def create_terrain(folder, fn_dem, scr_dem, stream=False, tile_size=None, geodesic=False, threads=1):
+    fn_sl_hs = folder + DemToTopoUtills.add_file_name_marker_tif(fn_dem, DemToTopoConsts.SLOPE_HILL_SHADE_EXT)
+    fn_sl_water = folder + DemToTopoUtills.add_file_name_marker_tif(fn_dem, DemToTopoConsts.SLOPE_WATER_EXT)
+
+    ds_dem = gdal.Open(scr_dem, GA_ReadOnly)
+    dem_band = ds_dem.GetRasterBand(1)
+    read_band = DemToTopoRawDem.open_raw_band(scr_dem, dem_band) or dem_band
+    dem_band_no_data_value = read_band.GetNoDataValue()
+    geo_transform = ds_dem.GetGeoTransform()
+    if geodesic:
+        ew_scales, ns_scales = DemToTopoGeodesy.row_scales(geo_transform, dem_band.YSize,
+                                                           DemToTopoGeodesy.is_geographic(ds_dem))
+
+    ds_sl_hs = DemToTopoUtills.create_raster(fn_sl_hs, ds_dem, GDT_Float32, DemToTopoConsts.SLOPE_NO_DATA_VALUE)
+    ds_sl_water = DemToTopoUtills.create_mask_raster(fn_sl_water, ds_dem)
+    sl_hs_band = ds_sl_hs.GetRasterBand(1)
+    sl_water_band = ds_sl_water.GetRasterBand(1)
+
+    def read(windows):
+        read_window, window = windows
+        return read_window, window, read_band.ReadAsArray(*read_window)
+
+    def compute(blocks):
+        read_window, window, dem_block = blocks
+        dem_block = dem_block.astype(numpy.float64)
+        if dem_band_no_data_value is not None:
+            dem_block[dem_block == dem_band_no_data_value] = numpy.nan
+        dem_block = pad_to_halo(dem_block, read_window, window)
+
+        if geodesic:
+            rows = slice(window[1], window[1] + window[3])
+            band_sl, band_hs = terrain_block(dem_block, geo_transform[1], geo_transform[5],
+                                             ew_scales[rows], ns_scales[rows])
+        else:
+            band_sl, band_hs = terrain_block(dem_block, geo_transform[1], geo_transform[5])
+
+        band_sl_hs = ((((band_sl / 90) * 255) * 0.7) + (band_hs * 0.3)) + 70
+        band_sl_water = numpy.equal(band_sl, 0).view(numpy.uint8)
+        return band_sl_hs, band_sl_water
+
+    def write(windows, bands):
+        window = windows[1]
+        sl_hs_band.WriteArray(bands[0], window[0], window[1])
+        sl_water_band.WriteArray(bands[1], window[0], window[1])
+
+    # Threads work on stripes.
+    window_x_size, window_y_size = DemToTopoUtills.get_window_size(dem_band, stream or threads > 1, tile_size)
+    DemToTopoUtills.process_windows(
+        DemToTopoUtills.get_windows(dem_band.XSize, dem_band.YSize, window_x_size, window_y_size, halo=1),
+        read, compute, write, threads)
+
+    dem_band = None
+    read_band = None
+    sl_hs_band = None
+    sl_water_band = None
+    ds_dem = None
+    ds_sl_hs = None
+    ds_sl_water = None
+
+    DemToTopoUtills.print_dot()
+    return fn_sl_hs, fn_sl_water
+
+
+# =============================================================================
+# pad_to_halo()
+#
+# Grow a block read with get_windows(halo=1) to exactly one pixel around the
+# write window. Sides on the raster edge have no halo to read and are
+# extrapolated linearly (2 * edge - next) the way gdaldem does with
+# computeEdges, nodata (nan) neighbours giving nan.
+
+def pad_to_halo(block, read_window, window):
+    if window[1] == read_window[1]:
+        block = numpy.vstack((extrapolate(block[0], block[1:2]), block))
+    if window[1] + window[3] == read_window[1] + read_window[3]:
+        block = numpy.vstack((block, extrapolate(block[-1], block[-2:-1])))
+    if window[0] == read_window[0]:
+        block = numpy.hstack((extrapolate(block[:, 0], block[:, 1:2].T).T, block))
+    if window[0] + window[2] == read_window[0] + read_window[2]:
+        block = numpy.hstack((block, extrapolate(block[:, -1], block[:, -2:-1].T).T))
+
+    return block
+
+
+def extrapolate(edge, inner):
+    if inner.shape[0] == 0:
+        return edge[numpy.newaxis]
+    return 2 * edge[numpy.newaxis] - inner
+
+
+# =============================================================================
+# terrain_block()
+#
+# Horn's 3x3 slope (degrees) and hillshade of a padded float64 block, with
+# the same parameters and formulas as the gdaldem slope and hillshade calls in
+# DemToTopo. nan marks nodata: a nodata centre gives the nodata outputs, a
+# nodata neighbour is replaced by the centre (computeEdges). The scales are
+# horizontal units to metres, a number or a (rows, 1) column per row.
+# Returns float32 slope and uint8 hillshade for the unpadded block.
+
+def terrain_block(dem_block, ewres, nsres, ew_scale=DemToTopoConsts.TERRAIN_SCALE,
+                  ns_scale=DemToTopoConsts.TERRAIN_SCALE):
+    rows = dem_block.shape[0] - 2
+    cols = dem_block.shape[1] - 2
+    centre = dem_block[1:-1, 1:-1]
+
+    # a b c
+    # d e f
+    # g h i
+    window = []
+    for row in range(3):
+        for col in range(3):
+            neighbour = dem_block[row:row + rows, col:col + cols]
+            window.append(numpy.where(numpy.isnan(neighbour), centre, neighbour))
+    a, b, c, d, _, f, g, h, i = window
+
+    # gradients in metres per metre
+    x = ((a + d + d + g) - (c + f + f + i)) / (8 * ewres * ew_scale)
+    y = ((g + h + h + i) - (a + b + b + c)) / (8 * nsres * ns_scale)
+    xx_plus_yy = x * x + y * y
+
+    # slope
+    band_sl = numpy.degrees(numpy.arctan(numpy.sqrt(xx_plus_yy)))
+
+    # hillshade
+    z_scaled = DemToTopoConsts.HILL_SHADE_Z_FACTOR
+    altitude = numpy.radians(DemToTopoConsts.HILL_SHADE_ALTITUDE)
+    azimuth = numpy.radians(DemToTopoConsts.HILL_SHADE_AZIMUTH)
+    cos_alt_mul_z_mul_254 = 254.0 * numpy.cos(altitude) * z_scaled
+
+    cang_mul_254 = ((254.0 * numpy.sin(altitude) -
+                     (y * cos_alt_mul_z_mul_254 * numpy.cos(azimuth) - x * cos_alt_mul_z_mul_254 * numpy.sin(azimuth)))
+                    / numpy.sqrt(1 + z_scaled * z_scaled * xx_plus_yy))
+    cang = numpy.where(cang_mul_254 <= 0.0, 1.0, 1.0 + cang_mul_254)
+
+    no_data = numpy.isnan(centre)
+    band_sl[no_data] = DemToTopoConsts.SLOPE_NO_DATA_VALUE
+    cang[no_data] = DemToTopoConsts.HILL_SHADE_NO_DATA_VALUE
+    band_hs = numpy.clip(numpy.floor(cang + 0.5), 0, 255).astype(numpy.uint8)
+
+    return band_sl.astype(numpy.float32), band_hs
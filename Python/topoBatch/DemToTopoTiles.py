@@ -0,0 +1,250 @@
+import json
+import math
+import os
+import sqlite3
+import numpy
+import DemToTopoConsts
+import DemToTopoUtills
+from osgeo import gdal
+from osgeo.gdalconst import *
+
+# Half the width of the web mercator world in metres, and its latitude limit.
+WEB_MERCATOR_HALF_WIDTH = 20037508.342789244
+WEB_MERCATOR_MAX_LATITUDE = 85.0511287798
+
+
+# =============================================================================
+# Slippy map tiles
+#
+# Tiles are made in two steps. While a DEM is processed, its topo image is
+# warped into every web mercator tile it touches, from min to max zoom, and
+# each tile is kept as an RGBA PNG "part", transparent outside the DEM. The
+# parts are committed with the products under DemToTopo_tiles/parts/{DEM}/.
+#
+# After the batch the tiles touched by the DEMs processed are composited
+# from the parts of every DEM that covers them, so tiles across DEM
+# boundaries are seamless. Only those tiles are written again, as XYZ or TMS
+# PNG / WebP files or into an MBTiles file. index.json records the tiles of
+# each DEM, so a changed DEM also updates the tiles it no longer covers.
+
+def create_tile_parts(fn_topo, parts_folder, tile_zoom):
+    ds_topo = gdal.Open(fn_topo, GA_ReadOnly)
+    geo_transform = ds_topo.GetGeoTransform()
+    west = geo_transform[0]
+    north = geo_transform[3]
+    east = west + geo_transform[1] * ds_topo.RasterXSize
+    south = north + geo_transform[5] * ds_topo.RasterYSize
+
+    part_count = 0
+    for zoom in range(tile_zoom[0], tile_zoom[1] + 1):
+        for x, y in get_tile_range(west, north, east, south, zoom):
+            ds_tile = gdal.Warp('', ds_topo, format='MEM', dstSRS='EPSG:3857',
+                                outputBounds=get_tile_bounds(x, y, zoom), width=DemToTopoConsts.TILE_SIZE,
+                                height=DemToTopoConsts.TILE_SIZE, dstAlpha=True,
+                                resampleAlg=DemToTopoConsts.TILE_RESAMPLING)
+            if ds_tile.GetRasterBand(ds_tile.RasterCount).ReadAsArray().any():
+                part_name = parts_folder + get_tile_path(zoom, x, y, '.png')
+                DemToTopoUtills.make_folder(os.path.dirname(part_name))
+                DemToTopoUtills.get_driver('PNG').CreateCopy(part_name, ds_tile)
+                part_count += 1
+            ds_tile = None
+
+    ds_topo = None
+    DemToTopoUtills.print_dot()
+    return part_count
+
+
+def get_tile_range(west, north, east, south, zoom):
+    # (x, y) of the XYZ tiles covering the bounds, y counted from the north.
+    tile_count = 2 ** zoom
+    x_min, y_min = lon_lat_to_tile(west, north, tile_count)
+    x_max, y_max = lon_lat_to_tile(east, south, tile_count)
+    for y in range(max(int(y_min), 0), min(math.ceil(y_max), tile_count)):
+        for x in range(max(int(x_min), 0), min(math.ceil(x_max), tile_count)):
+            yield x, y
+
+
+def lon_lat_to_tile(lon, lat, tile_count):
+    lat = math.radians(max(min(lat, WEB_MERCATOR_MAX_LATITUDE), -WEB_MERCATOR_MAX_LATITUDE))
+    x = (lon + 180) / 360 * tile_count
+    y = (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * tile_count
+    return x, y
+
+
+def get_tile_bounds(x, y, zoom):
+    # (min x, min y, max x, max y) in web mercator metres.
+    tile_width = 2 * WEB_MERCATOR_HALF_WIDTH / 2 ** zoom
+    min_x = x * tile_width - WEB_MERCATOR_HALF_WIDTH
+    max_y = WEB_MERCATOR_HALF_WIDTH - y * tile_width
+    return min_x, max_y - tile_width, min_x + tile_width, max_y
+
+
+def get_tile_path(zoom, x, y, extension):
+    return str(zoom) + '/' + str(x) + '/' + str(y) + extension
+
+
+def list_tile_parts(parts_folder):
+    tiles = []
+    for root, folders, file_names in os.walk(parts_folder):
+        for file_name in file_names:
+            zoom, x = os.path.relpath(root, parts_folder).split(os.sep)[-2:]
+            tiles.append((int(zoom), int(x), int(os.path.splitext(file_name)[0])))
+
+    return tiles
+
+
+# =============================================================================
+# update_tiles()
+#
+# Composite and write the tiles of the DEMs in file_names, the DEMs of the
+# batch that were processed. Returns the number of tiles updated.
+
+def update_tiles(folder, file_names, tile_scheme, tile_format):
+    tiles_folder = folder + DemToTopoConsts.TILES_FOLDER
+    parts_folder = tiles_folder + DemToTopoConsts.TILE_PARTS_FOLDER
+    index = load_tile_index(tiles_folder)
+
+    updated_tiles = set()
+    for file_name in file_names:
+        dem_name = os.path.splitext(os.path.basename(file_name))[0]
+        dem_tiles = list_tile_parts(parts_folder + dem_name + '/')
+        updated_tiles.update(tuple(tile) for tile in index.get(dem_name, []))
+        updated_tiles.update(dem_tiles)
+        index[dem_name] = sorted(dem_tiles)
+    save_tile_index(tiles_folder, index)
+
+    tile_dem_names = {}
+    for dem_name in sorted(index):
+        for tile in index[dem_name]:
+            if tuple(tile) in updated_tiles:
+                tile_dem_names.setdefault(tuple(tile), []).append(dem_name)
+
+    if tile_scheme == 'mbtiles':
+        writer = MBTilesWriter(tiles_folder + DemToTopoConsts.MBTILES_FILE, tile_format)
+    else:
+        writer = TileFolderWriter(tiles_folder, tile_scheme, tile_format)
+    for zoom, x, y in sorted(updated_tiles):
+        part_names = [parts_folder + dem_name + '/' + get_tile_path(zoom, x, y, '.png')
+                      for dem_name in tile_dem_names.get((zoom, x, y), [])]
+        if part_names:
+            writer.write(zoom, x, y, encode_tile(composite_parts(part_names), tile_format))
+        else:
+            writer.remove(zoom, x, y)
+    writer.close()
+
+    return len(updated_tiles)
+
+
+def load_tile_index(tiles_folder):
+    index_name = tiles_folder + DemToTopoConsts.TILE_INDEX_FILE
+    if not os.path.exists(index_name):
+        return {}
+    with open(index_name) as file:
+        return json.load(file)
+
+
+def save_tile_index(tiles_folder, index):
+    os.makedirs(tiles_folder, exist_ok=True)
+    index_name = tiles_folder + DemToTopoConsts.TILE_INDEX_FILE
+    with open(index_name + '.tmp', 'w') as file:
+        json.dump(index, file)
+    os.replace(index_name + '.tmp', index_name)
+
+
+def composite_parts(part_names):
+    # RGBA "over" compositing of the parts, in DEM name order.
+    rgb = numpy.zeros((3, DemToTopoConsts.TILE_SIZE, DemToTopoConsts.TILE_SIZE))
+    alpha = numpy.zeros((DemToTopoConsts.TILE_SIZE, DemToTopoConsts.TILE_SIZE))
+    for part_name in part_names:
+        ds_part = gdal.Open(part_name, GA_ReadOnly)
+        part = ds_part.ReadAsArray().astype(numpy.float64)
+        ds_part = None
+
+        part_alpha = part[3] / 255
+        rgb = part[:3] * part_alpha + rgb * (1 - part_alpha)
+        alpha = part_alpha + alpha * (1 - part_alpha)
+
+    # rgb is premultiplied by alpha
+    covered = alpha > 0
+    rgb[:, covered] /= alpha[covered]
+    tile = numpy.empty((4, DemToTopoConsts.TILE_SIZE, DemToTopoConsts.TILE_SIZE), numpy.uint8)
+    tile[:3] = numpy.clip(numpy.rint(rgb), 0, 255)
+    tile[3] = numpy.clip(numpy.rint(alpha * 255), 0, 255)
+
+    return tile
+
+
+def encode_tile(tile, tile_format):
+    driver_name, options = DemToTopoConsts.TILE_FORMATS[tile_format]
+    ds_tile = DemToTopoUtills.get_driver('MEM').Create('', tile.shape[2], tile.shape[1], tile.shape[0], GDT_Byte)
+    ds_tile.WriteRaster(0, 0, tile.shape[2], tile.shape[1], tile.tobytes())
+
+    tile_name = DemToTopoConsts.VSIMEM_FOLDER + 'DemToTopo_tile.' + tile_format
+    ds_encoded = DemToTopoUtills.get_driver(driver_name).CreateCopy(tile_name, ds_tile, options=options)
+    ds_encoded = None
+    ds_tile = None
+
+    tile_file = gdal.VSIFOpenL(tile_name, 'rb')
+    tile_bytes = gdal.VSIFReadL(1, gdal.VSIStatL(tile_name).size, tile_file)
+    gdal.VSIFCloseL(tile_file)
+    DemToTopoUtills.remove_file(tile_name)
+
+    return tile_bytes
+
+
+class TileFolderWriter:
+    # {zoom}/{x}/{y} files, y from the north (xyz) or the south (tms).
+    def __init__(self, tiles_folder, tile_scheme, tile_format):
+        self.tiles_folder = tiles_folder + tile_scheme + '/'
+        self.tile_scheme = tile_scheme
+        self.extension = '.' + tile_format
+
+    def get_tile_name(self, zoom, x, y):
+        if self.tile_scheme == 'tms':
+            y = 2 ** zoom - 1 - y
+        return self.tiles_folder + get_tile_path(zoom, x, y, self.extension)
+
+    def write(self, zoom, x, y, tile_bytes):
+        tile_name = self.get_tile_name(zoom, x, y)
+        os.makedirs(os.path.dirname(tile_name), exist_ok=True)
+        with open(tile_name + '.tmp', 'wb') as file:
+            file.write(tile_bytes)
+        os.replace(tile_name + '.tmp', tile_name)
+
+    def remove(self, zoom, x, y):
+        tile_name = self.get_tile_name(zoom, x, y)
+        if os.path.exists(tile_name):
+            os.remove(tile_name)
+
+    def close(self):
+        pass
+
+
+class MBTilesWriter:
+    # MBTiles 1.3, tile_row counted from the south. One transaction per update.
+    def __init__(self, file_name, tile_format):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                                'tile_row INTEGER, tile_data BLOB, '
+                                'PRIMARY KEY (zoom_level, tile_column, tile_row))')
+        self.connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                                    [('name', 'DemToTopo'), ('format', tile_format), ('type', 'baselayer'),
+                                     ('version', '1.0')])
+
+    def write(self, zoom, x, y, tile_bytes):
+        self.connection.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                                (zoom, x, 2 ** zoom - 1 - y, tile_bytes))
+
+    def remove(self, zoom, x, y):
+        self.connection.execute('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                (zoom, x, 2 ** zoom - 1 - y))
+
+    def close(self):
+        min_zoom, max_zoom = self.connection.execute('SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles').fetchone()
+        if min_zoom is not None:
+            self.connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                                        [('minzoom', str(min_zoom)), ('maxzoom', str(max_zoom))])
+        self.connection.commit()
+        self.connection.close()
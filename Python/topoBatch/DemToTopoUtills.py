@@ -1,4 +1,16 @@
+import collections
+import concurrent.futures
 import os
+import shutil
+import DemToTopoConsts
+from osgeo import gdal, ogr, osr
+from osgeo.gdalconst import *
+
+show_progress = True
+
+# Drivers and the WGS84 spatial reference, looked up once per process.
+drivers = {}
+wgs84 = {}
 
 
 def add_file_name_marker_tif(scr_filename, tag):
@@ -16,5 +28,174 @@ def add_file_name_marker_prj(scr_filename, tag):
     return scr_filename_split[0] + tag + '.prj'
 
 
+def add_file_name_marker_vrt(scr_filename, tag):
+    scr_filename_split = os.path.splitext(os.path.basename(scr_filename))
+    return scr_filename_split[0] + tag + '.vrt'
+
+
+def set_progress(enabled):
+    global show_progress
+    show_progress = enabled
+
+
 def print_dot():
-    print('.', end="")
+    if show_progress:
+        print('.', end="")
+
+
+def remove_file(file_name):
+    if file_name.startswith('/vsimem/'):
+        gdal.Unlink(file_name)
+    else:
+        os.remove(file_name)
+
+
+# File system helpers that also work on GDAL's /vsimem/ file system.
+
+def file_exists(file_name):
+    if file_name.startswith('/vsimem/'):
+        return gdal.VSIStatL(file_name) is not None
+    return os.path.exists(file_name)
+
+
+def rename_file(file_name, new_file_name):
+    # Atomic within one file system.
+    if file_name.startswith('/vsimem/'):
+        gdal.Rename(file_name, new_file_name)
+    else:
+        os.replace(file_name, new_file_name)
+
+
+def make_folder(folder):
+    if folder.startswith('/vsimem/'):
+        gdal.MkdirRecursive(folder, 0o755)
+    else:
+        os.makedirs(folder, exist_ok=True)
+
+
+def remove_folder(folder):
+    if folder.startswith('/vsimem/'):
+        gdal.RmdirRecursive(folder)
+    else:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def write_text(file_name, text):
+    if file_name.startswith('/vsimem/'):
+        gdal.FileFromMemBuffer(file_name, text.encode())
+    else:
+        with open(file_name, 'w') as file:
+            file.write(text)
+
+
+def get_driver(name):
+    if name not in drivers:
+        drivers[name] = gdal.GetDriverByName(name)
+    return drivers[name]
+
+
+def get_vector_driver(name):
+    if ('ogr', name) not in drivers:
+        drivers[('ogr', name)] = ogr.GetDriverByName(name)
+    return drivers[('ogr', name)]
+
+
+def get_wgs84():
+    if 'srs' not in wgs84:
+        spatial_ref = osr.SpatialReference()
+        spatial_ref.ImportFromEPSG(4326)
+        wgs84['srs'] = spatial_ref
+    return wgs84['srs']
+
+
+def get_wgs84_esri_wkt():
+    # The .prj content for the shape files.
+    if 'esri_wkt' not in wgs84:
+        spatial_ref = get_wgs84().Clone()
+        spatial_ref.MorphToESRI()
+        wgs84['esri_wkt'] = spatial_ref.ExportToWkt()
+    return wgs84['esri_wkt']
+
+
+def get_window_size(band, stream=False, tile_size=None):
+    # The whole raster unless streaming. A streaming run uses square tile_size
+    # windows, or full width stripes built from whole GTiff blocks and capped
+    # at STREAM_WINDOW_PIXELS, so peak memory no longer depends on the input size.
+    if tile_size:
+        return tile_size, tile_size
+    if not stream:
+        return band.XSize, band.YSize
+
+    block_x_size, block_y_size = band.GetBlockSize()
+    block_rows = max(1, DemToTopoConsts.STREAM_WINDOW_PIXELS // (band.XSize * block_y_size))
+    return band.XSize, min(band.YSize, block_rows * block_y_size)
+
+
+def get_windows(x_size, y_size, window_x_size, window_y_size, halo=0):
+    # Yields (read window, write window) pairs as (x_off, y_off, x_size, y_size).
+    # The read window is the write window grown by halo pixels on each side,
+    # clipped to the raster, so neighbourhood kernels see the same pixels at
+    # a window seam as they would on the whole raster.
+    for y_off in range(0, y_size, window_y_size):
+        height = min(window_y_size, y_size - y_off)
+        read_y_off = max(y_off - halo, 0)
+        read_height = min(y_off + height + halo, y_size) - read_y_off
+        for x_off in range(0, x_size, window_x_size):
+            width = min(window_x_size, x_size - x_off)
+            read_x_off = max(x_off - halo, 0)
+            read_width = min(x_off + width + halo, x_size) - read_x_off
+            yield (read_x_off, read_y_off, read_width, read_height), (x_off, y_off, width, height)
+
+
+# =============================================================================
+# process_windows()
+#
+# Run compute over windows on a pool of threads. GDAL datasets are not safe
+# to share between threads, so read(window) and write(window, result) run
+# on the calling thread, in window order, while up to threads windows are
+# computed. NumPy releases the GIL in its kernels so the blocks compute in
+# parallel. threads 1 runs everything in line.
+
+def process_windows(windows, read, compute, write, threads=1):
+    if threads <= 1:
+        for window in windows:
+            write(window, compute(read(window)))
+        return
+
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for window in windows:
+            pending.append((window, executor.submit(compute, read(window))))
+            if len(pending) > threads:
+                done_window, future = pending.popleft()
+                write(done_window, future.result())
+        while pending:
+            done_window, future = pending.popleft()
+            write(done_window, future.result())
+
+
+def configure_gdal(threads=1, cache_size=None):
+    # GDAL's own threads, used to encode compressed GTiff and COG output,
+    # and its raster block cache in MB.
+    if threads > 1:
+        gdal.SetConfigOption('GDAL_NUM_THREADS', str(threads))
+    if cache_size:
+        gdal.SetCacheMax(cache_size * 1024 * 1024)
+
+
+def create_raster(file_name, ds_source, data_type, no_data_value=None, options=None):
+    # Single band GTiff with the size, projection and geotransform of ds_source.
+    driver_tiff = get_driver('GTiff')
+    ds_out = driver_tiff.Create(file_name, ds_source.RasterXSize, ds_source.RasterYSize, 1, data_type,
+                                options=options or [])
+    ds_out.SetProjection(ds_source.GetProjection())
+    ds_out.SetGeoTransform(ds_source.GetGeoTransform())
+    if no_data_value is not None:
+        ds_out.GetRasterBand(1).SetNoDataValue(no_data_value)
+    return ds_out
+
+
+def create_mask_raster(file_name, ds_source):
+    # 0/1 Byte mask stored as 1 bit, 0 is nodata so the band is its own
+    # mask for gdal.Polygonize.
+    return create_raster(file_name, ds_source, GDT_Byte, 0, DemToTopoConsts.MASK_CREATION_OPTIONS)
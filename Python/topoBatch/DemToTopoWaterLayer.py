@@ -0,0 +1,118 @@
+import os
+import DemToTopoConsts
+import DemToTopoGeodesy
+import DemToTopoUtills
+from osgeo import ogr
+
+
+# =============================================================================
+# Batch water layer
+#
+# The water polygons of the whole batch in one GeoPackage or FlatGeobuf layer
+# with a spatial index, so the water of a region is one query rather than
+# opening the _SL_poly.shp of every DEM. Each polygon records its source DEM
+# file, its ground area in hectares and its centroid (longitude, latitude).
+#
+# A GeoPackage is updated in place: the polygons of each DEM processed
+# replace its earlier ones in one transaction per DEM. A FlatGeobuf file
+# can't be updated and is written again from the _SL_poly.shp of every DEM.
+
+def update_water_layer(folder, fn_layer, dem_file_list, processed_file_list):
+    driver_name, options = get_layer_format(fn_layer)
+    rebuild = driver_name != 'GPKG' or not os.path.exists(fn_layer)
+    water = {}
+    for file_name in (dem_file_list if rebuild else processed_file_list):
+        water[file_name] = read_water(folder, file_name) or []
+
+    return write_water_layer(fn_layer, water, rebuild)
+
+
+def get_layer_format(fn_layer):
+    extension = os.path.splitext(fn_layer)[1].lower()
+    if extension not in DemToTopoConsts.WATER_LAYER_FORMATS:
+        raise ValueError('Unknown water layer format: ' + fn_layer)
+    return DemToTopoConsts.WATER_LAYER_FORMATS[extension]
+
+
+def read_water(folder, file_name):
+    # The water polygons of a DEM, or None when it has no _SL_poly.shp.
+    fn_sl_poly = folder + DemToTopoUtills.add_file_name_marker_shp(file_name, DemToTopoConsts.SLOPE_POLY_EXT)
+    if not os.path.exists(fn_sl_poly):
+        return None
+
+    ds_sl_poly = ogr.Open(fn_sl_poly)
+    geometries = [feature.GetGeometryRef().Clone() for feature in ds_sl_poly.GetLayer()]
+    ds_sl_poly = None
+    return geometries
+
+
+# =============================================================================
+# write_water_layer()
+#
+# Write water, {source: [geometries]}, into the layer. rebuild creates the
+# layer again with only these polygons, otherwise the polygons of each
+# source replace the ones already in the layer. Returns the number of
+# polygons written.
+
+def write_water_layer(fn_layer, water, rebuild=True):
+    driver_name, options = get_layer_format(fn_layer)
+    driver = DemToTopoUtills.get_vector_driver(driver_name)
+    if rebuild:
+        if os.path.exists(fn_layer):
+            driver.DeleteDataSource(fn_layer)
+        ds_layer = driver.CreateDataSource(fn_layer)
+        layer = create_layer(ds_layer, options)
+    else:
+        ds_layer = ogr.Open(fn_layer, 1)
+        layer = ds_layer.GetLayerByName(DemToTopoConsts.WATER_LAYER_NAME)
+
+    # One transaction per source where the driver supports them.
+    use_transaction = layer.TestCapability(ogr.OLCTransactions)
+    layer_definition = layer.GetLayerDefn()
+    polygon_count = 0
+    for source, geometries in water.items():
+        if use_transaction:
+            layer.StartTransaction()
+        if not rebuild:
+            delete_source(layer, source)
+        for geometry in geometries:
+            layer.CreateFeature(create_feature(layer_definition, source, geometry))
+            polygon_count += 1
+        if use_transaction:
+            layer.CommitTransaction()
+
+    layer = None
+    ds_layer = None
+
+    DemToTopoUtills.print_dot()
+    return polygon_count
+
+
+def create_layer(ds_layer, options):
+    layer = ds_layer.CreateLayer(DemToTopoConsts.WATER_LAYER_NAME, DemToTopoUtills.get_wgs84(),
+                                 geom_type=ogr.wkbMultiPolygon, options=options)
+    layer.CreateField(ogr.FieldDefn('source', ogr.OFTString))
+    for field_name in ['area_ha', 'centroid_lon', 'centroid_lat']:
+        layer.CreateField(ogr.FieldDefn(field_name, ogr.OFTReal))
+
+    return layer
+
+
+def create_feature(layer_definition, source, geometry):
+    centroid = geometry.Centroid()
+    feature = ogr.Feature(layer_definition)
+    feature.SetField('source', source)
+    feature.SetField('area_ha', DemToTopoGeodesy.geometry_area(geometry) / DemToTopoConsts.SQUARE_METRES_PER_HECTARE)
+    feature.SetField('centroid_lon', centroid.GetX())
+    feature.SetField('centroid_lat', centroid.GetY())
+    feature.SetGeometry(ogr.ForceToMultiPolygon(geometry))
+
+    return feature
+
+
+def delete_source(layer, source):
+    layer.SetAttributeFilter("source = '" + source.replace("'", "''") + "'")
+    fids = [feature.GetFID() for feature in layer]
+    layer.SetAttributeFilter(None)
+    for fid in fids:
+        layer.DeleteFeature(fid)
@@ -31,13 +31,171 @@
 #  DEALINGS IN THE SOFTWARE.
 # ******************************************************************************
 
+import threading
 import numpy
+import DemToTopoConsts
 import DemToTopoUtills
 from osgeo import gdal
 from osgeo.gdalconst import *
 
+# The colour water is painted in, as a (bands, 1) column.
+WATER_COLOR = numpy.array([[DemToTopoConsts.RED_VAL], [DemToTopoConsts.GREEN_VAL], [DemToTopoConsts.BLUE_VAL]],
+                          numpy.uint8)
 
-def hsv_merge(folder, fn_dem, scr_slope_hill_shade, scr_color_ref):
+
+def hsv_merge(folder, fn_dem, scr_slope_hill_shade, scr_color_ref, tile_size=None, kernel='reference',
+              scr_water=None, threads=1):
+    # scr_water, the filtered water mask, is painted in the water colour.
+    # threads merges that many blocks at a time, each thread with its own
+    # float32 workspace.
+    hill_dataset = gdal.Open(scr_slope_hill_shade, GA_ReadOnly)
+    color_data_set = gdal.Open(scr_color_ref, GA_ReadOnly)
+    water_dataset = gdal.Open(scr_water, GA_ReadOnly) if scr_water else None
+    water_band = water_dataset.GetRasterBand(1) if water_dataset else None
+
+    dst_color_filename = folder + DemToTopoUtills.add_file_name_marker_tif(fn_dem, '_Topo')
+    datatype = GDT_Byte
+    out_format = 'GTiff'
+
+    # define output format, name, size, type and set projection
+    out_driver = DemToTopoUtills.get_driver(out_format)
+    out_dataset = out_driver.Create(dst_color_filename, color_data_set.RasterXSize,
+                                    color_data_set.RasterYSize, color_data_set.RasterCount, datatype)
+    out_dataset.SetProjection(hill_dataset.GetProjection())
+    out_dataset.SetGeoTransform(hill_dataset.GetGeoTransform())
+
+    band_count = color_data_set.RasterCount
+    band_list = list(range(1, band_count + 1))
+    hill_band = hill_dataset.GetRasterBand(1)
+    hill_band_no_data_value = hill_band.GetNoDataValue()
+
+    # loop over blocks of lines to apply hillshade, one read of all the colour
+    # bands and one write of all the output bands per block.
+    window_x_size, window_y_size = DemToTopoUtills.get_window_size(hill_band, True, tile_size)
+    block_shape = (min(window_y_size, hill_band.YSize), min(window_x_size, hill_band.XSize))
+    workspaces = threading.local()
+    dst_buffer = numpy.empty((band_count,) + block_shape, numpy.uint8) if threads <= 1 else None
+
+    def read(windows):
+        # load RGB(A) and Hillshade arrays
+        window = windows[0]
+        color_block = numpy.frombuffer(color_data_set.ReadRaster(*window, band_list=band_list), dtype=numpy.uint8)
+        color_block = color_block.reshape(band_count, window[3], window[2])
+        water_block = water_band.ReadAsArray(*window) if water_band is not None else None
+        return color_block, hill_band.ReadAsArray(*window), water_block
+
+    def merge(blocks):
+        color_block, hill_block, water_block = blocks
+
+        # the alpha band is passed through
+        if kernel == 'reference':
+            dst_color = merge_block(color_block, hill_block, hill_band_no_data_value)
+            if band_count == 4:
+                dst_color = numpy.concatenate((dst_color, color_block[3:4]))
+        else:
+            if not hasattr(workspaces, 'workspace'):
+                workspaces.workspace = HsvWorkspace(block_shape)
+            workspaces.workspace.set_shape(hill_block.shape)
+            # blocks in flight on other threads each need their own output
+            if dst_buffer is not None:
+                dst_color = dst_buffer[:, :hill_block.shape[0], :hill_block.shape[1]]
+            else:
+                dst_color = numpy.empty((band_count,) + hill_block.shape, numpy.uint8)
+            merge_block_f32(color_block, hill_block, hill_band_no_data_value, workspaces.workspace, dst_color,
+                            kernel == 'fused')
+            if band_count == 4:
+                dst_color[3] = color_block[3]
+
+        if water_block is not None:
+            burn_water(dst_color, water_block)
+        return dst_color
+
+    def write(windows, dst_color):
+        out_dataset.WriteRaster(*windows[0], dst_color.tobytes(), band_list=band_list)
+
+    DemToTopoUtills.process_windows(
+        DemToTopoUtills.get_windows(hill_band.XSize, hill_band.YSize, window_x_size, window_y_size),
+        read, merge, write, threads)
+
+    hill_dataset = None
+    color_data_set = None
+    out_dataset = None
+    hill_band = None
+    water_band = None
+    water_dataset = None
+
+    return dst_color_filename
+
+
+def burn_water(dst_color, water_block):
+    # Water pixels of a (bands, rows, columns) block get the water colour.
+    dst_color[:3, water_block != 0] = WATER_COLOR
+
+
+# =============================================================================
+# merge_block()
+#
+# Replace the value of the colour block with the hillshade using the float64
+# reference kernels. Returns a new [r,g,b] uint8 block.
+
+def merge_block(color_block, hill_block, hill_band_no_data_value):
+    # convert to HSV
+    hsv = rgb_to_hsv(color_block[0], color_block[1], color_block[2])
+
+    # if there's nodata on the hillband, use the v value from the color
+    # dataset instead of the hillshade value.
+    if hill_band_no_data_value is not None:
+        equal_to_nodata = numpy.equal(hill_block, hill_band_no_data_value)
+        v = numpy.choose(equal_to_nodata, (hill_block, hsv[2]))
+    else:
+        v = hill_block
+
+    # replace v with hillshade
+    hsv_adjusted = numpy.asarray([hsv[0], hsv[1], v])
+
+    # convert back to RGB
+    return hsv_to_rgb(hsv_adjusted)
+
+
+# =============================================================================
+# merge_block_f32()
+#
+# As merge_block() with the float32 kernels, writing [r,g,b] into the
+# preallocated out block. fused skips the [h,s,v] stage. Channels can differ
+# from the reference kernels by one through float32 rounding.
+
+def merge_block_f32(color_block, hill_block, hill_band_no_data_value, ws, out, fused=False):
+    r = color_block[0]
+    g = color_block[1]
+    b = color_block[2]
+
+    if fused:
+        numpy.copyto(ws.v, hill_block)
+        if hill_band_no_data_value is not None:
+            numpy.equal(hill_block, hill_band_no_data_value, out=ws.mask)
+            numpy.maximum(r, g, out=ws.channel)
+            numpy.maximum(ws.channel, b, out=ws.channel)
+            numpy.copyto(ws.v, ws.channel, where=ws.mask)
+        replace_value_rgb(r, g, b, ws.v, ws, out)
+    else:
+        h, s, v = rgb_to_hsv_f32(r, g, b, ws)
+        if hill_band_no_data_value is not None:
+            numpy.not_equal(hill_block, hill_band_no_data_value, out=ws.mask)
+            numpy.copyto(v, hill_block, where=ws.mask)
+        else:
+            numpy.copyto(v, hill_block)
+        hsv_to_rgb_f32(h, s, v, ws, out)
+
+    return out
+
+
+# =============================================================================
+# hsv_merge_scanline()
+#
+# The original line by line merge, kept as the reference for benchmarks and
+# for checking that hsv_merge output is byte identical.
+
+def hsv_merge_scanline(folder, fn_dem, scr_slope_hill_shade, scr_color_ref):
     hill_dataset = gdal.Open(scr_slope_hill_shade, GA_ReadOnly)
     color_data_set = gdal.Open(scr_color_ref, GA_ReadOnly)
 
@@ -176,3 +334,130 @@ def hsv_to_rgb(hsv):
     rgb = numpy.asarray([r, g, b]).astype(numpy.uint8)
 
     return rgb
+
+
+# =============================================================================
+# HsvWorkspace
+#
+# Preallocated float32 buffers for the allocation free kernels below. The
+# buffers are sized for the largest block once; set_shape() points the named
+# buffers at views for a smaller (edge) block so nothing is allocated per block.
+
+class HsvWorkspace:
+    FLOAT_BUFFERS = ('maxc', 'minc', 'delta', 'h', 's', 'v', 'rc', 'gc', 'bc', 'f', 'p', 'q', 't', 'channel')
+
+    def __init__(self, shape):
+        self.buffers = {name: numpy.empty(shape, numpy.float32) for name in self.FLOAT_BUFFERS}
+        self.buffers['mask'] = numpy.empty(shape, numpy.bool_)
+        self.buffers['i'] = numpy.empty(shape, numpy.intp)
+        self.set_shape(shape)
+
+    def set_shape(self, shape):
+        for name, buffer in self.buffers.items():
+            setattr(self, name, buffer[:shape[0], :shape[1]])
+
+
+# =============================================================================
+# rgb_to_hsv_f32()
+#
+# float32 version of rgb_to_hsv() writing into the workspace. Returns the
+# workspace h, s and v buffers.
+
+def rgb_to_hsv_f32(r, g, b, ws):
+    numpy.maximum(r, g, out=ws.maxc)
+    numpy.maximum(ws.maxc, b, out=ws.maxc)
+    numpy.minimum(r, g, out=ws.minc)
+    numpy.minimum(ws.minc, b, out=ws.minc)
+
+    numpy.copyto(ws.v, ws.maxc)
+
+    # s = (maxc - minc) / max(1, maxc)
+    numpy.subtract(ws.maxc, ws.minc, out=ws.delta)
+    numpy.maximum(ws.maxc, 1.0, out=ws.s)
+    numpy.divide(ws.delta, ws.s, out=ws.s)
+
+    # reset zero differences to ones to avoid divide by zeros later.
+    numpy.equal(ws.delta, 0.0, out=ws.mask)
+    numpy.add(ws.delta, ws.mask, out=ws.delta)
+
+    numpy.subtract(ws.maxc, r, out=ws.rc)
+    numpy.divide(ws.rc, ws.delta, out=ws.rc)
+    numpy.subtract(ws.maxc, g, out=ws.gc)
+    numpy.divide(ws.gc, ws.delta, out=ws.gc)
+    numpy.subtract(ws.maxc, b, out=ws.bc)
+    numpy.divide(ws.bc, ws.delta, out=ws.bc)
+
+    # maxc is always one of r, g or b; red wins over green wins over blue.
+    numpy.subtract(ws.gc, ws.rc, out=ws.h)
+    numpy.add(ws.h, 4.0, out=ws.h)
+
+    numpy.equal(ws.maxc, g, out=ws.mask)
+    numpy.subtract(ws.rc, ws.bc, out=ws.channel)
+    numpy.add(ws.channel, 2.0, out=ws.channel)
+    numpy.copyto(ws.h, ws.channel, where=ws.mask)
+
+    numpy.equal(ws.maxc, r, out=ws.mask)
+    numpy.subtract(ws.bc, ws.gc, out=ws.channel)
+    numpy.copyto(ws.h, ws.channel, where=ws.mask)
+
+    numpy.divide(ws.h, 6.0, out=ws.h)
+    numpy.mod(ws.h, 1.0, out=ws.h)
+
+    return ws.h, ws.s, ws.v
+
+
+# =============================================================================
+# hsv_to_rgb_f32()
+#
+# float32 version of hsv_to_rgb() writing the uint8 [r,g,b] result into out.
+
+def hsv_to_rgb_f32(h, s, v, ws, out):
+    numpy.multiply(h, 6.0, out=ws.f)
+    numpy.copyto(ws.i, ws.f, casting='unsafe')
+    numpy.subtract(ws.f, ws.i, out=ws.f)
+
+    # p = v * (1 - s)
+    numpy.subtract(1.0, s, out=ws.p)
+    numpy.multiply(ws.p, v, out=ws.p)
+    # q = v * (1 - s * f)
+    numpy.multiply(s, ws.f, out=ws.q)
+    numpy.subtract(1.0, ws.q, out=ws.q)
+    numpy.multiply(ws.q, v, out=ws.q)
+    # t = v * (1 - s * (1 - f))
+    numpy.subtract(1.0, ws.f, out=ws.t)
+    numpy.multiply(ws.t, s, out=ws.t)
+    numpy.subtract(1.0, ws.t, out=ws.t)
+    numpy.multiply(ws.t, v, out=ws.t)
+
+    # float32 rounding can give h == 1.0, wrap the sector back to 0.
+    for band, choices in enumerate(((v, ws.q, ws.p, ws.p, ws.t, v),
+                                    (ws.t, v, v, ws.q, ws.p, ws.p),
+                                    (ws.p, ws.p, ws.t, v, v, ws.q))):
+        numpy.choose(ws.i, choices, out=ws.channel, mode='wrap')
+        numpy.copyto(out[band], ws.channel, casting='unsafe')
+
+    return out
+
+
+# =============================================================================
+# replace_value_rgb()
+#
+# Fused rgb -> hsv -> replace v -> rgb. Replacing v keeps hue and saturation,
+# which scales every channel by v / max(r, g, b); a black pixel becomes grey
+# v. Writes the uint8 [r,g,b] result into out without building [h,s,v].
+
+def replace_value_rgb(r, g, b, v, ws, out):
+    numpy.maximum(r, g, out=ws.maxc)
+    numpy.maximum(ws.maxc, b, out=ws.maxc)
+
+    # (c + (maxc == 0)) * v / max(maxc, 1) handles the black pixels
+    numpy.equal(ws.maxc, 0.0, out=ws.mask)
+    numpy.maximum(ws.maxc, 1.0, out=ws.maxc)
+    numpy.divide(v, ws.maxc, out=ws.s)
+
+    for band, c in enumerate((r, g, b)):
+        numpy.add(c, ws.mask, out=ws.channel)
+        numpy.multiply(ws.channel, ws.s, out=ws.channel)
+        numpy.copyto(out[band], ws.channel, casting='unsafe')
+
+    return out
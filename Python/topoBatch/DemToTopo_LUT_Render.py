@@ -0,0 +1,152 @@
+import numpy
+import DemToTopoConsts
+import DemToTopoRawDem
+import DemToTopoUtills
+import DemToTopo_HSV_Merge
+from osgeo import gdal
+from osgeo.gdalconst import *
+
+
+# =============================================================================
+# lut_render()
+#
+# Render the topographic image straight from the DEM and the slope hillshade
+# texture. Every output pixel only depends on the altitude and the intensity,
+# so the colour relief and the HSV merge are done once per colour file into
+# a (altitude bin x 256 intensities) -> RGB table, cached on the ColorRamp,
+# and each block is a single fancy indexing pass. Replaces
+# create_color_relief() and hsv_merge(). scr_water, the filtered water
+# mask, is painted in the water colour. threads renders that many blocks at
+# a time.
+
+def lut_render(folder, fn_dem, scr_dem, scr_slope_hill_shade, color_ramp, tile_size=None, scr_water=None,
+               threads=1):
+    topo_lut = get_topo_lut(color_ramp)
+
+    dem_dataset = gdal.Open(scr_dem, GA_ReadOnly)
+    hill_dataset = gdal.Open(scr_slope_hill_shade, GA_ReadOnly)
+    water_dataset = gdal.Open(scr_water, GA_ReadOnly) if scr_water else None
+    water_band = water_dataset.GetRasterBand(1) if water_dataset else None
+
+    dst_color_filename = folder + DemToTopoUtills.add_file_name_marker_tif(fn_dem, DemToTopoConsts.TOPO_EXT)
+    out_driver = DemToTopoUtills.get_driver('GTiff')
+    out_dataset = out_driver.Create(dst_color_filename, hill_dataset.RasterXSize, hill_dataset.RasterYSize, 3,
+                                    GDT_Byte)
+    out_dataset.SetProjection(hill_dataset.GetProjection())
+    out_dataset.SetGeoTransform(hill_dataset.GetGeoTransform())
+
+    dem_band = dem_dataset.GetRasterBand(1)
+    # A BIL DEM is read from a memory map of the file.
+    dem_band = DemToTopoRawDem.open_raw_band(scr_dem, dem_band) or dem_band
+    hill_band = hill_dataset.GetRasterBand(1)
+    dem_band_no_data_value = dem_band.GetNoDataValue()
+    hill_band_no_data_value = hill_band.GetNoDataValue()
+
+    def read(windows):
+        window = windows[0]
+        water_block = water_band.ReadAsArray(*window) if water_band is not None else None
+        return dem_band.ReadAsArray(*window), hill_band.ReadAsArray(*window), water_block
+
+    def render(blocks):
+        dem_block, hill_block, water_block = blocks
+        dst_color = render_block(dem_block, hill_block, dem_band_no_data_value, hill_band_no_data_value, topo_lut)
+        if water_block is not None:
+            dst_color[water_block != 0] = DemToTopo_HSV_Merge.WATER_COLOR[:, 0]
+        return dst_color
+
+    def write(windows, dst_color):
+        # pixel interleaved [rows, cols, rgb] straight from the table
+        window = windows[0]
+        out_dataset.WriteRaster(*window, dst_color.tobytes(), band_list=[1, 2, 3],
+                                buf_pixel_space=3, buf_line_space=3 * window[2], buf_band_space=1)
+
+    window_x_size, window_y_size = DemToTopoUtills.get_window_size(hill_band, True, tile_size)
+    DemToTopoUtills.process_windows(
+        DemToTopoUtills.get_windows(hill_band.XSize, hill_band.YSize, window_x_size, window_y_size),
+        read, render, write, threads)
+
+    dem_band = None
+    hill_band = None
+    water_band = None
+    water_dataset = None
+    dem_dataset = None
+    hill_dataset = None
+    out_dataset = None
+
+    DemToTopoUtills.print_dot()
+    return dst_color_filename
+
+
+def get_topo_lut(color_ramp):
+    return color_ramp.get_table('topo_lut', build_topo_lut)
+
+
+# =============================================================================
+# build_topo_lut()
+#
+# Returns (lut, min_altitude, altitude_step, bin_values, nodata_bin,
+# bin_colors). lut is the flattened [bin * 256 + intensity] -> RGB table,
+# merged with the same reference kernels as hsv_merge(). bin_values holds the
+# HSV value of each bin colour, used where the texture is nodata. nodata_bin
+# is the extra bin for an 'nv' ramp entry, or None. bin_colors holds the RGB
+# colour of each bin, merged with merge_block() where the texture is out of
+# the 0..255 range of the table.
+
+def build_topo_lut(color_ramp, altitude_step=DemToTopoConsts.LUT_ALTITUDE_STEP):
+    altitudes = color_ramp.altitudes
+    nodata_color = color_ramp.nodata_color
+
+    min_altitude = altitudes[0]
+    bin_count = int(numpy.ceil((altitudes[-1] - min_altitude) / altitude_step)) + 1
+    bin_colors = color_ramp.colors_at(min_altitude + numpy.arange(bin_count) * altitude_step)
+    nodata_bin = None
+    if nodata_color is not None:
+        nodata_bin = bin_count
+        bin_colors = numpy.vstack((bin_colors, numpy.asarray([nodata_color], dtype=numpy.uint8)))
+
+    intensities = numpy.arange(256, dtype=numpy.float64)
+    lut = numpy.empty((len(bin_colors), 256, 3), dtype=numpy.uint8)
+    for start in range(0, len(bin_colors), DemToTopoConsts.LUT_CHUNK_BINS):
+        chunk = bin_colors[start:start + DemToTopoConsts.LUT_CHUNK_BINS]
+        color_block = numpy.repeat(chunk.T[:, :, numpy.newaxis], 256, axis=2)
+        hill_block = numpy.repeat(intensities[numpy.newaxis, :], len(chunk), axis=0)
+        merged = DemToTopo_HSV_Merge.merge_block(color_block, hill_block, None)
+        lut[start:start + len(chunk)] = merged.transpose(1, 2, 0)
+
+    bin_values = bin_colors.max(axis=1).astype(numpy.intp)
+
+    return lut.reshape(-1, 3), min_altitude, altitude_step, bin_values, nodata_bin, bin_colors
+
+
+# =============================================================================
+# render_block()
+#
+# Look up the [rows, cols, rgb] topo colours of a DEM block. The intensity is
+# the texture value rounded down to a byte. The texture runs past 255 on
+# steep slopes and is negative where the slope is nodata; the reference merge
+# wraps those channels through its uint8 cast, so those pixels are merged
+# with the reference kernel instead of looked up.
+
+def render_block(dem_block, hill_block, dem_band_no_data_value, hill_band_no_data_value, topo_lut):
+    lut, min_altitude, altitude_step, bin_values, nodata_bin, bin_colors = topo_lut
+    last_bin = len(bin_values) - 1 if nodata_bin is None else nodata_bin - 1
+
+    bins = numpy.rint((dem_block - min_altitude) / altitude_step)
+    bins = numpy.clip(bins, 0, last_bin).astype(numpy.intp)
+    if nodata_bin is not None and dem_band_no_data_value is not None:
+        bins[dem_block == dem_band_no_data_value] = nodata_bin
+
+    intensity = numpy.clip(hill_block, 0, 255).astype(numpy.intp)
+    out_of_range = (hill_block < 0) | (hill_block >= 256)
+    if hill_band_no_data_value is not None:
+        equal_to_nodata = hill_block == hill_band_no_data_value
+        intensity[equal_to_nodata] = bin_values[bins[equal_to_nodata]]
+        out_of_range &= ~equal_to_nodata
+
+    dst_color = lut[bins * 256 + intensity]
+    if out_of_range.any():
+        # (rgb, 1, pixels) colour block of the bins
+        color_block = bin_colors[bins[out_of_range]].T[:, numpy.newaxis, :]
+        merged = DemToTopo_HSV_Merge.merge_block(color_block, hill_block[out_of_range][numpy.newaxis], None)
+        dst_color[out_of_range] = merged[:, 0, :].T
+    return dst_color